@@ -5,120 +5,365 @@ Currently using isolated sessions for demo velocity.
 Risk: Logic interleaven rollbacks are impossible
 """
 
-from typing import Optional
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (
+    and_,
+    bindparam,
+    create_engine,
+    delete,
+    event,
+    insert,
+    or_,
+    select,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import aliased, sessionmaker
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
 
 import db.models as models
-from dto import ThreadDTO, SummaryDTO, LinkDTO, MessageDTO
+from dto import (
+    ThreadDTO,
+    SummaryDTO,
+    SummaryGraphDTO,
+    LinkDTO,
+    MessageDTO,
+    ThreadBundleDTO,
+)
+
+# Connection pool tuning for server backends.
+# Every DB method opens a short-lived session, so warm connections must be reused.
+POOL_OPTIONS = {
+    "poolclass": QueuePool,
+    "pool_size": 20,
+    "max_overflow": 10,
+    "pool_recycle": 1800,  # seconds
+    "pool_pre_ping": True,
+    "pool_use_lifo": True,  # Keeps the hot connections warm
+}
+# Write-ahead logging lets reads proceed during a write, and skips an fsync per commit
+SQLITE_PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL")
+QUERY_CACHE_SIZE = 1200
+RESULT_CACHE_SIZE = 1024  # Count of cached per-thread fetch results
+# Bounds how stale a cached result may get, when other processes write the same database
+RESULT_CACHE_TTL = 2.0  # seconds
+
+# Statements are built once, so that their cache keys stay stable across calls.
+# Note: Plain columns are selected, as rows are handed out as DTOs, not ORM objects
+THREAD_COLUMNS = (
+    models.Thread.id,
+    models.Thread.topic,
+    models.Thread.prompt,
+    models.Thread.created_at,
+)
+MESSAGE_COLUMNS = (
+    models.Message.id,
+    models.Message.thread_id,
+    models.Message.content,
+    models.Message.embedding_file,
+    models.Message.created_at,
+)
+LINK_COLUMNS = (
+    models.Link.id,
+    models.Link.thread_id,
+    models.Link.previous_message_id,
+    models.Link.next_message_id,
+    models.Link.created_at,
+)
+SUMMARY_COLUMNS = (
+    models.Summary.id,
+    models.Summary.content,
+    models.Summary.embedding_file,
+    models.Summary.start_message_id,
+    models.Summary.end_message_id,
+    models.Summary.created_at,
+)
+
+SELECT_THREADS = select(*THREAD_COLUMNS)
+SELECT_THREAD_MESSAGES = (
+    select(*MESSAGE_COLUMNS)
+    .where(models.Message.thread_id == bindparam("thread_id"))
+    .order_by(models.Message.id)
+)
+SELECT_MESSAGE = select(*MESSAGE_COLUMNS).where(
+    models.Message.id == bindparam("message_id")
+)
+SELECT_THREAD_LINKS = (
+    select(*LINK_COLUMNS)
+    .where(models.Link.thread_id == bindparam("thread_id"))
+    .order_by(models.Link.id)
+)
+SELECT_THREAD_SUMMARIES = (
+    select(*SUMMARY_COLUMNS)
+    .join(models.Message, models.Message.id == models.Summary.start_message_id)
+    .where(models.Message.thread_id == bindparam("thread_id"))
+)
+# The parent of a summary ends at the message linked before its start message.
+# Note: Summaries are one link apart, so a plain join is enough, no recursion
+ParentSummary = aliased(models.Summary)
+SELECT_THREAD_SUMMARY_GRAPH = (
+    select(
+        models.Summary.id.label("summary_id"),
+        ParentSummary.id.label("parent_summary_id"),
+        models.Summary.start_message_id,
+        models.Summary.end_message_id,
+    )
+    .join(models.Message, models.Message.id == models.Summary.start_message_id)
+    .outerjoin(
+        models.Link, models.Link.next_message_id == models.Summary.start_message_id
+    )
+    .outerjoin(
+        ParentSummary, ParentSummary.end_message_id == models.Link.previous_message_id
+    )
+    .where(models.Message.thread_id == bindparam("thread_id"))
+    .order_by(models.Summary.id)
+)
+# A message has at most one incoming link, and starts at most one summary.
+# So, every message of the thread maps to exactly one row.
+SELECT_THREAD_BUNDLE = (
+    select(
+        *MESSAGE_COLUMNS,
+        models.Link.id.label("link_id"),
+        models.Link.previous_message_id,
+        models.Link.created_at.label("link_created_at"),
+        models.Summary.id.label("summary_id"),
+        models.Summary.content.label("summary_content"),
+        models.Summary.embedding_file.label("summary_embedding_file"),
+        models.Summary.end_message_id.label("summary_end_message_id"),
+        models.Summary.created_at.label("summary_created_at"),
+        ParentSummary.id.label("parent_summary_id"),
+    )
+    .select_from(models.Message)
+    .outerjoin(models.Link, models.Link.next_message_id == models.Message.id)
+    .outerjoin(models.Summary, models.Summary.start_message_id == models.Message.id)
+    .outerjoin(
+        ParentSummary, ParentSummary.end_message_id == models.Link.previous_message_id
+    )
+    .where(models.Message.thread_id == bindparam("thread_id"))
+    .order_by(models.Message.id)
+)
+INSERT_MESSAGE = insert(models.Message).returning(models.Message.id)
+INSERT_LINK = insert(models.Link).returning(models.Link.id)
+DELETE_SUMMARY = delete(models.Summary).where(
+    models.Summary.id == bindparam("summary_id")
+)
+DELETE_SUMMARIES = delete(models.Summary).where(
+    models.Summary.id.in_(bindparam("summary_ids", expanding=True))
+)
+DELETE_MESSAGES = delete(models.Message).where(
+    models.Message.id.in_(bindparam("message_ids", expanding=True))
+)
+DELETE_MESSAGE_LINKS = delete(models.Link).where(
+    or_(
+        models.Link.previous_message_id.in_(bindparam("message_ids", expanding=True)),
+        models.Link.next_message_id.in_(bindparam("message_ids", expanding=True)),
+    )
+)
+DELETE_LINK = delete(models.Link).where(
+    and_(
+        models.Link.previous_message_id == bindparam("previous_message_id"),
+        models.Link.next_message_id == bindparam("next_message_id"),
+    )
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 
 
 class DB:
     """Separated functionalities of a relational database."""
 
-    def __init__(self, uri: str):
+    def __init__(self, uri: str, result_cache_ttl: float = RESULT_CACHE_TTL):
         # "postgresql+psycopg2://{user}:{password}@{host}/{name}"
-        self.db_engine = create_engine(uri)
-        self.Session = sessionmaker(bind=self.db_engine)
+        url = make_url(uri)
+        engine_options = {}
+        # Note: SQLite (esp. in-memory) must keep its default single connection pool
+        if url.get_backend_name() != "sqlite":
+            engine_options.update(POOL_OPTIONS)
+        elif url.query.get("mode") == "memory":
+            # Note: A shared-cache database lives while any of its connections is open
+            engine_options["poolclass"] = SingletonThreadPool
+        self.db_engine = create_engine(
+            uri, query_cache_size=QUERY_CACHE_SIZE, **engine_options
+        )
+        # Note: In-memory databases, shared-cache ones included, have no journal to tune
+        if (
+            url.get_backend_name() == "sqlite"
+            and url.database not in (None, "", ":memory:")
+            and url.query.get("mode") != "memory"
+        ):
+            event.listen(self.db_engine, "connect", _apply_sqlite_pragmas)
+        # Note: A plain in-memory SQLite database is private to the thread that opened it
+        self.thread_local = url.get_backend_name() == "sqlite" and url.database in (
+            None,
+            "",
+            ":memory:",
+        )
+        # Note: Reads run without explicit transactions, and rows stay loaded after commit
+        self.Session = sessionmaker(bind=self.db_engine, expire_on_commit=False)
         # Create tables if they don't exist
         models.Base.metadata.create_all(self.db_engine)
+        # Per-thread fetch results, keyed on (fetch, thread_id, thread version)
+        # Note: Only writes made through this instance bump the versions,
+        # so the TTL bounds the staleness of other writers. A TTL of 0 disables the cache
+        self._result_cache_ttl = result_cache_ttl
+        self._result_cache: OrderedDict[tuple[str, int, int], tuple[float, Any]] = (
+            OrderedDict()
+        )
+        # Versions are unique stamps. Threads without one share the base version
+        self._versions = itertools.count(1)
+        self._base_version = 0
+        self._thread_versions: OrderedDict[int, int] = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _cached(self, name: str, thread_id: int, fetch: Callable[[], Any]) -> Any:
+        """
+        Serves a per-thread fetch from the LRU result cache.
+        Cached results are shared, so they must be treated as read-only
+        """
+        if not self._result_cache_ttl:
+            return fetch()
+        # Note: The key and expiry are taken before the fetch.
+        # A write landing mid-fetch bumps the version, so the result is never served
+        now = time.monotonic()
+        with self._cache_lock:
+            key = (
+                name,
+                thread_id,
+                self._thread_versions.get(thread_id, self._base_version),
+            )
+            entry = self._result_cache.get(key)
+            if entry is not None and entry[0] > now:
+                self._result_cache.move_to_end(key)
+                return entry[1]
+        result = fetch()
+        with self._cache_lock:
+            self._result_cache[key] = (now + self._result_cache_ttl, result)
+            self._result_cache.move_to_end(key)
+            if len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+        return result
+
+    def _invalidate(self, thread_id: Optional[int] = None) -> None:
+        """
+        Outdates cached results of a thread, by bumping its version.
+        Without a thread_id, the versions of every thread are bumped
+        """
+        with self._cache_lock:
+            version = next(self._versions)
+            if thread_id is None:
+                self._base_version = version
+                self._thread_versions.clear()
+                return
+            self._thread_versions[thread_id] = version
+            self._thread_versions.move_to_end(thread_id)
+            if len(self._thread_versions) > RESULT_CACHE_SIZE:
+                # Note: The evicted thread falls back to the base version, so it is bumped too
+                self._thread_versions.popitem(last=False)
+                self._base_version = version
+
+    def _fetch_thread_rows(self, statement, thread_id: int) -> list[dict]:
+        with self.Session() as session:
+            return [
+                dict(row)
+                for row in session.execute(
+                    statement, {"thread_id": thread_id}
+                ).mappings()
+            ]
 
     def fetch_threads(self) -> list[ThreadDTO]:
         with self.Session() as session:
-            threads: list[ThreadDTO] = []
-            with session.begin():
-                for thread in session.query(models.Thread).all():
-                    threads.append(
-                        {
-                            "id": thread.id,
-                            "topic": thread.topic,
-                            "prompt": thread.prompt,
-                            "created_at": thread.created_at,
-                        }
-                    )
-            return threads
+            return [dict(row) for row in session.execute(SELECT_THREADS).mappings()]
 
     def fetch_messages(self, thread_id: int) -> list[MessageDTO]:
-        with self.Session() as session:
-            messages: list[MessageDTO] = []
-            with session.begin():
-                for message in (
-                    session.query(models.Message)
-                    .filter(models.Message.thread_id == thread_id)
-                    .all()
-                ):
-                    messages.append(
-                        {
-                            "id": message.id,
-                            "content": message.content,
-                            "thread_id": message.thread,
-                            "created_at": message.created_at,
-                            "embedding_file": None,
-                        }
-                    )
-            return messages
+        return self._cached(
+            "messages",
+            thread_id,
+            lambda: self._fetch_thread_rows(SELECT_THREAD_MESSAGES, thread_id),
+        )
 
     def fetch_message(self, message_id: int) -> MessageDTO:
         with self.Session() as session:
-            with session.begin():
-                message = (
-                    session.query(models.Message)
-                    .filter(models.Message.id == message_id)
-                    .first()
-                )
-                return {
-                    "id": message.id,
-                    "content": message.content,
-                    "thread_id": message.thread_id,
-                    "created_at": message.created_at,
-                    "embedding_file": None,
-                }
+            return dict(
+                session.execute(SELECT_MESSAGE, {"message_id": message_id})
+                .mappings()
+                .one()
+            )
 
     def fetch_links(self, thread_id: int) -> list[LinkDTO]:
-        with self.Session() as session:
-            links: list[LinkDTO] = []
-            with session.begin():
-                for link in (
-                    session.query(models.Link)
-                    .filter(models.Thread.id == thread_id)
-                    .all()
-                ):
-                    links.append(
-                        {
-                            "id": link.id,
-                            "thread_id": link.thread_id,
-                            "next_message_id": link.next_message_id,
-                            "previous_message_id": link.previous_message_id,
-                            "created_at": link.created_at,
-                        }
-                    )
-            return links
+        return self._cached(
+            "links",
+            thread_id,
+            lambda: self._fetch_thread_rows(SELECT_THREAD_LINKS, thread_id),
+        )
 
     def fetch_summaries(self, thread_id: int) -> list[SummaryDTO]:
+        return self._cached(
+            "summaries",
+            thread_id,
+            lambda: self._fetch_thread_rows(SELECT_THREAD_SUMMARIES, thread_id),
+        )
+
+    def fetch_summary_graph(self, thread_id: int) -> list[SummaryGraphDTO]:
+        """Fetches the summaries of a thread, along with their parent summary ids"""
+        return self._cached(
+            "summary_graph",
+            thread_id,
+            lambda: self._fetch_thread_rows(SELECT_THREAD_SUMMARY_GRAPH, thread_id),
+        )
+
+    def fetch_thread_bundle(self, thread_id: int) -> ThreadBundleDTO:
+        """Fetches messages, links and summaries of a thread in a single round trip"""
+        return self._cached(
+            "bundle", thread_id, lambda: self._fetch_thread_bundle(thread_id)
+        )
+
+    def _fetch_thread_bundle(self, thread_id: int) -> ThreadBundleDTO:
         with self.Session() as session:
-            summaries: list[SummaryDTO] = []
-            with session.begin():
-                for summary in (
-                    session.query(models.Summary)
-                    .join(
-                        models.Message,
-                        models.Message.id == models.Summary.start_message_id,
+            bundle: ThreadBundleDTO = {"messages": [], "links": [], "summaries": []}
+            for row in session.execute(
+                SELECT_THREAD_BUNDLE, {"thread_id": thread_id}
+            ).mappings():
+                bundle["messages"].append(
+                    {
+                        "id": row["id"],
+                        "thread_id": row["thread_id"],
+                        "content": row["content"],
+                        "embedding_file": row["embedding_file"],
+                        "created_at": row["created_at"],
+                    }
+                )
+                if row["link_id"] is not None:
+                    bundle["links"].append(
+                        {
+                            "id": row["link_id"],
+                            "thread_id": row["thread_id"],
+                            "previous_message_id": row["previous_message_id"],
+                            "next_message_id": row["id"],
+                            "created_at": row["link_created_at"],
+                        }
                     )
-                    .filter(models.Message.thread_id == thread_id)
-                    .all()
-                ):
-                    summaries.append(
+                if row["summary_id"] is not None:
+                    bundle["summaries"].append(
                         {
-                            "id": summary.id,
-                            "content": summary.content,
-                            "start_message_id": summary.start_message_id,
-                            "end_message_id": summary.end_message_id,
-                            "created_at": summary.created_at,
-                            "embedding_file": None,
+                            "id": row["summary_id"],
+                            "content": row["summary_content"],
+                            "embedding_file": row["summary_embedding_file"],
+                            "start_message_id": row["id"],
+                            "end_message_id": row["summary_end_message_id"],
+                            "created_at": row["summary_created_at"],
+                            "parent_summary_id": row["parent_summary_id"],
                         }
                     )
-            return summaries
+            return bundle
 
     def insert_message(self, thread_id: int, content: str) -> int:
         with self.Session() as session:
@@ -126,7 +371,75 @@ class DB:
                 message = models.Message(thread_id=thread_id, content=content)
                 session.add(message)
                 session.flush()
-                return message.id
+        self._invalidate(thread_id)
+        return message.id
+
+    def insert_message_with_link(
+        self, thread_id: int, content: str, prev_message_id: Optional[int]
+    ) -> tuple[int, Optional[int]]:
+        """
+        Inserts a message and its link to the previous message in one transaction.
+        Returns the message id, and the link id (None for a root message)
+        """
+        # Note: Core inserts, as the ORM unit of work is not needed for two rows
+        with self.Session() as session:
+            with session.begin():
+                message_id = session.execute(
+                    INSERT_MESSAGE, {"thread_id": thread_id, "content": content}
+                ).scalar_one()
+                link_id = None
+                if prev_message_id is not None:
+                    link_id = session.execute(
+                        INSERT_LINK,
+                        {
+                            "thread_id": thread_id,
+                            "previous_message_id": prev_message_id,
+                            "next_message_id": message_id,
+                        },
+                    ).scalar_one()
+        self._invalidate(thread_id)
+        return message_id, link_id
+
+    def bulk_insert_messages(
+        self,
+        thread_id: int,
+        contents: list[str],
+        prev_message_id: Optional[int] = None,
+    ) -> list[int]:
+        """
+        Bulk imports a linear chain of messages, attached to prev_message_id.
+        Uses core inserts, skipping the ORM unit of work.
+        """
+        if not contents:
+            return []
+        with self.Session() as session:
+            with session.begin():
+                message_ids = list(
+                    session.execute(
+                        insert(models.Message).returning(
+                            models.Message.id, sort_by_parameter_order=True
+                        ),
+                        [
+                            {"thread_id": thread_id, "content": content}
+                            for content in contents
+                        ],
+                    ).scalars()
+                )
+                links = [
+                    {
+                        "thread_id": thread_id,
+                        "previous_message_id": previous_id,
+                        "next_message_id": next_id,
+                    }
+                    for previous_id, next_id in zip(
+                        [prev_message_id, *message_ids[:-1]], message_ids
+                    )
+                    if previous_id is not None
+                ]
+                if links:
+                    session.execute(insert(models.Link), links)
+        self._invalidate(thread_id)
+        return message_ids
 
     def insert_link(
         self, thread_id: int, prev_message_id: int, next_message_id: int
@@ -140,7 +453,8 @@ class DB:
                 )
                 session.add(link)
                 session.flush()
-                return link.id
+        self._invalidate(thread_id)
+        return link.id
 
     def insert_thread(
         self, prompt: Optional[str] = None, topic: Optional[str] = None
@@ -160,7 +474,12 @@ class DB:
         start_message_id: int,
         end_message_id: int,
         embedding_file: Optional[str],
+        thread_id: Optional[int] = None,
     ) -> int:
+        """
+        Inserts a summary.
+        Note: Without thread_id, the cached results of every thread are outdated
+        """
         with self.Session() as session:
             with session.begin():
                 summary = models.Summary(
@@ -171,35 +490,77 @@ class DB:
                 )
                 session.add(summary)
                 session.flush()
-                return summary.id
+        self._invalidate(thread_id)
+        return summary.id
+
+    def replace_summary(
+        self,
+        summary_id: int,
+        summaries: list[tuple[str, int, int]],
+        thread_id: Optional[int] = None,
+    ) -> list[int]:
+        """
+        Replaces a summary with (content, start_message_id, end_message_id) summaries,
+        in one transaction. Returns the new summary ids, in order
+        Note: Without thread_id, the cached results of every thread are outdated
+        """
+        with self.Session() as session:
+            with session.begin():
+                session.execute(DELETE_SUMMARY, {"summary_id": summary_id})
+                summary_ids = list(
+                    session.execute(
+                        insert(models.Summary).returning(
+                            models.Summary.id, sort_by_parameter_order=True
+                        ),
+                        [
+                            {
+                                "content": content,
+                                "start_message_id": start_message_id,
+                                "end_message_id": end_message_id,
+                            }
+                            for content, start_message_id, end_message_id in summaries
+                        ],
+                    ).scalars()
+                )
+        self._invalidate(thread_id)
+        return summary_ids
 
     def delete_summary(
-        self, summary_id: int
+        self, summary_id: int, thread_id: Optional[int] = None
     ):  # A split node causes split in summary too!
         with self.Session() as session:
             with session.begin():
-                summary = (
-                    session.query(models.Summary)
-                    .filter(models.Summary.id == summary_id)
-                    .first()
-                )
-                session.delete(summary)
+                session.execute(DELETE_SUMMARY, {"summary_id": summary_id})
+        self._invalidate(thread_id)
 
-    def delete_link(self, previous_message_id: int, next_message_id: int):
+    def delete_summaries(self, summary_ids: list[int], thread_id: Optional[int] = None):
+        """Deletes many summaries in a single statement"""
+        if not summary_ids:
+            return
+        with self.Session() as session:
+            with session.begin():
+                session.execute(DELETE_SUMMARIES, {"summary_ids": summary_ids})
+        self._invalidate(thread_id)
+
+    def delete_link(
+        self,
+        previous_message_id: int,
+        next_message_id: int,
+        thread_id: Optional[int] = None,
+    ):
         """Deletes one link. Used to detatch branch"""
         with self.Session() as session:
             with session.begin():
-                link = (
-                    session.query(models.Link)
-                    .filter(
-                        models.Link.previous_message_id == previous_message_id
-                        and models.Link.next_message_id == next_message_id
-                    )
-                    .first()
+                session.execute(
+                    DELETE_LINK,
+                    {
+                        "previous_message_id": previous_message_id,
+                        "next_message_id": next_message_id,
+                    },
                 )
-                session.delete(link)
+        self._invalidate(thread_id)
 
-    def delete_message(self, _id: int):
+    def delete_message(self, _id: int, thread_id: Optional[int] = None):
         """
         Deletes a single messasge.
         """
@@ -211,3 +572,17 @@ class DB:
                     .first()
                 )
                 session.delete(message)
+        self._invalidate(thread_id)
+
+    def delete_messages(self, message_ids: list[int], thread_id: Optional[int] = None):
+        """
+        Deletes many messages, and every link to or from them, in one transaction.
+        Note: Summaries spanning the messages must be deleted beforehand
+        """
+        if not message_ids:
+            return
+        with self.Session() as session:
+            with session.begin():
+                session.execute(DELETE_MESSAGE_LINKS, {"message_ids": message_ids})
+                session.execute(DELETE_MESSAGES, {"message_ids": message_ids})
+        self._invalidate(thread_id)
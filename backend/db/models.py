@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -21,6 +21,8 @@ class Thread(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    # Note: Serves thread scans in id order, without a sort
+    __table_args__ = (Index("ix_messages_thread_id_id", "thread_id", "id"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     thread_id = Column(Integer, ForeignKey("threads.id"), nullable=False)
     content = Column(String, nullable=False)
@@ -56,8 +58,12 @@ class Summary(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     content = Column(String, nullable=False)
     embedding_file = Column(String, nullable=True)
-    start_message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
-    end_message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    start_message_id = Column(
+        Integer, ForeignKey("messages.id"), nullable=False, index=True
+    )
+    end_message_id = Column(
+        Integer, ForeignKey("messages.id"), nullable=False, index=True
+    )
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
@@ -73,10 +79,23 @@ class Summary(Base):
 
 class Link(Base):
     __tablename__ = "links"
+    __table_args__ = (
+        Index(
+            "ix_links_thread_prev_next",
+            "thread_id",
+            "previous_message_id",
+            "next_message_id",
+        ),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
+    # Note: Thread scans are served by the composite index above
     thread_id = Column(Integer, ForeignKey("threads.id"), nullable=False)
-    previous_message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
-    next_message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    previous_message_id = Column(
+        Integer, ForeignKey("messages.id"), nullable=True, index=True
+    )
+    next_message_id = Column(
+        Integer, ForeignKey("messages.id"), nullable=False, index=True
+    )
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
@@ -26,9 +26,26 @@ class SummaryDTO(TypedDict):
     created_at: datetime
 
 
+class SummaryGraphDTO(TypedDict):
+    summary_id: int
+    parent_summary_id: Optional[int]
+    start_message_id: int
+    end_message_id: int
+
+
+class BundledSummaryDTO(SummaryDTO):
+    parent_summary_id: Optional[int]
+
+
 class LinkDTO(TypedDict):
     id: int
     thread_id: int
     previous_message_id: int
     next_message_id: int
     created_at: datetime
+
+
+class ThreadBundleDTO(TypedDict):
+    messages: list[MessageDTO]
+    links: list[LinkDTO]
+    summaries: list[BundledSummaryDTO]
@@ -1,12 +1,21 @@
+import asyncio
 import os
-from typing import Annotated, TypedDict
+from typing import Annotated, Iterator, TypedDict
 
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import AIMessage
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    RemoveMessage,
+)
+from langchain_core.runnables import RunnableLambda
+
+from services.llm_ops import llm_concurrency
 
 # Configurations
 load_dotenv()
@@ -18,27 +27,53 @@ class Agent:
     class State(TypedDict):
         messages: Annotated[list, add_messages]
 
-    def __init__(self, llm: ChatOpenAI):
+    def __init__(self, llm: ChatOpenAI, history_window: int = 20):
         self._llm = llm
-        self._graph_builder = StateGraph(Agent.State)
-        self._graph = None
+        # Count of messages kept per thread, including the latest response
+        # Note: At least the latest user message and its response must fit
+        if history_window < 2:
+            raise ValueError(f"history_window must be at least 2, got {history_window}")
+        self._history_window = history_window
+        # Bounds the concurrent async requests to the LLM provider
+        self._semaphore = asyncio.Semaphore(llm_concurrency())
         self._memory = MemorySaver()
+        # Compiled once, so that no request pays for the graph build
+        self.graph = self._build_graph()
 
-    @property
-    def graph(self):
+    def _build_graph(self):
         """Graphical connections within the chat. Can be extended with tools in the future"""
-        if self._graph is None:
+        graph_builder = StateGraph(Agent.State)
+
+        def chatbot(state: Agent.State):
+            history, removals = self._window(state["messages"])
+            return {"messages": [*removals, self._llm.invoke(history)]}
+
+        async def achatbot(state: Agent.State):
+            history, removals = self._window(state["messages"])
+            async with self._semaphore:
+                response = await self._llm.ainvoke(history)
+            return {"messages": [*removals, response]}
 
-            def chatbot(state: Agent.State):
-                return {"messages": [self._llm.invoke(state["messages"])]}
+        # Note: The async variant is picked by ainvoke/astream
+        graph_builder.add_node("chatbot", RunnableLambda(chatbot, afunc=achatbot))
 
-            self._graph_builder.add_node("chatbot", chatbot)
+        graph_builder.add_edge(START, "chatbot")
+        graph_builder.add_edge("chatbot", END)
 
-            self._graph_builder.add_edge(START, "chatbot")
-            self._graph_builder.add_edge("chatbot", END)
+        return graph_builder.compile(checkpointer=self._memory)
 
-            self._graph = self._graph_builder.compile(checkpointer=self._memory)
-        return self._graph
+    def _window(
+        self, messages: list[BaseMessage]
+    ) -> tuple[list[BaseMessage], list[RemoveMessage]]:
+        """
+        Splits the thread state into the history sent to the LLM, and removals of older messages.
+        Keeps the checkpointed state bounded, so replays do not grow with the thread
+        """
+        # Note: One slot is left for the upcoming response
+        overflow = max(len(messages) - self._history_window + 1, 0)
+        return messages[overflow:], [
+            RemoveMessage(id=message.id) for message in messages[:overflow]
+        ]
 
     def generate_response(self, user_content: str, thread_id: str) -> str:
         """Generates the final response from the LLM"""
@@ -51,6 +86,30 @@ class Agent:
                 if isinstance(value["messages"][-1], AIMessage):
                     return value["messages"][-1]
 
+    async def agenerate_response(self, user_content: str, thread_id: str) -> AIMessage:
+        """
+        Async variant of generate_response.
+        Lets the generation overlap with other I/O, such as the topic shift check.
+        """
+        state = await self.graph.ainvoke(
+            {"messages": [{"role": "user", "content": user_content}]},
+            config={"configurable": {"thread_id": thread_id}},
+        )
+        return state["messages"][-1]
+
+    def stream_response(self, user_content: str, thread_id: str) -> Iterator[str]:
+        """
+        Streams the response from the LLM, token by token.
+        Note: The full response is still checkpointed, once the stream is exhausted
+        """
+        for chunk, _ in self.graph.stream(
+            {"messages": [{"role": "user", "content": user_content}]},
+            config={"configurable": {"thread_id": thread_id}},
+            stream_mode="messages",
+        ):
+            if isinstance(chunk, AIMessageChunk) and chunk.content:
+                yield chunk.content
+
 
 if __name__ == "__main__":
     llm = ChatOpenAI(model=os.getenv("OPENAI_MODEL"))
@@ -1,23 +1,28 @@
-from typing import Optional, TypedDict
+import threading
+import weakref
+from typing import Optional
 from dataclasses import dataclass, field
 from collections import OrderedDict
 from db.db import DB
+from dto import ThreadBundleDTO
 
 
-class MessageNode(TypedDict):
+@dataclass(slots=True)
+class MessageNode:
     id: int
     content: str
-    parent_id: Optional[int]
-    child_ids: list[int]
+    parent_id: Optional[int] = None
+    child_ids: list[int] = field(default_factory=list)
 
 
-class SummaryNode(TypedDict):
+@dataclass(slots=True)
+class SummaryNode:
     id: int
     content: str
     start_message_id: int
     end_message_id: int
-    parent_id: Optional[int]
-    child_ids: list[int]
+    parent_id: Optional[int] = None
+    child_ids: list[int] = field(default_factory=list)
 
 
 @dataclass
@@ -31,74 +36,106 @@ class SummaryIndex:
     summary_id_lookup: dict[int, SummaryNode] = field(
         default_factory=dict
     )  # summary_id --> SummaryNode
+    summarized_message_ids: set[int] = field(
+        default_factory=set
+    )  # message_ids spanned by any summary
 
 
 class MessageTree:
-    def __init__(self, thread_id: int, db: DB):
+    def __init__(
+        self, thread_id: int, db: DB, bundle: Optional[ThreadBundleDTO] = None
+    ):
         self._db = db
         self.thread_id = thread_id
-        self.root_message_id, self.index = self._load_message_tree(thread_id)
-
-    def _load_message_tree(self, thread_id: int) -> tuple[int, dict[int, MessageNode]]:
+        if bundle is None:
+            bundle = self._db.fetch_thread_bundle(thread_id)
+        self.root_message_id, self.index = self._load_message_tree(bundle)
+        # message_id --> count of messages up to the nearest summary end ancestor.
+        # Summary ends are reset by the SummaryTree
+        self.depth_since_summary = self._load_depths()
+
+    def _load_message_tree(
+        self, bundle: ThreadBundleDTO
+    ) -> tuple[Optional[int], dict[int, MessageNode]]:
         """
         Builds an in-memory tree of messages from the thread's links.
         Returns a dict of message_id → MessageNode
         """
 
-        messages = self._db.fetch_messages(thread_id)
-        links = self._db.fetch_links(thread_id)
+        messages = bundle["messages"]
+        links = bundle["links"]
 
         nodes: dict[int, MessageNode] = {
-            msg["id"]: {
-                "id": msg["id"],
-                "content": msg["content"],
-                "parent_id": None,
-                "child_ids": [],
-            }
-            for msg in messages
+            msg["id"]: MessageNode(msg["id"], msg["content"]) for msg in messages
         }
 
         for link in links:
-            parent = nodes.get(link["previous_message_id"])
-            child = nodes.get(link["next_message_id"])
+            parent_id = link["previous_message_id"]
+            child_id = link["next_message_id"]
 
-            child["parent_id"] = parent["id"]
-            parent["child_ids"].append(child["id"])
+            nodes[child_id].parent_id = parent_id
+            nodes[parent_id].child_ids.append(child_id)
 
         for node in nodes.values():
-            if node["parent_id"] is None:  # Only root node will not have parent_id
-                return node["id"], nodes
-
-        raise AssertionError("root_message_id must exist for the message tree")
+            if node.parent_id is None:  # Only root node will not have parent_id
+                return node.id, nodes
+
+        # A thread without messages yet, has no root
+        assert not nodes, "root_message_id must exist for the message tree"
+        return None, nodes
+
+    def _load_depths(self) -> dict[int, int]:
+        """Computes the depth of every message, with a top-down walk from the root"""
+        depths: dict[int, int] = {}
+        if self.root_message_id is None:
+            return depths
+        depths[self.root_message_id] = 1
+        message_ids = [self.root_message_id]
+        while message_ids:
+            message_id = message_ids.pop()
+            for child_id in self.index[message_id].child_ids:
+                depths[child_id] = depths[message_id] + 1
+                message_ids.append(child_id)
+        return depths
 
     def add_message(
         self, message_id: int, message_content: str, prev_message_id: Optional[int]
     ):
         """Adds message to the tree"""
-        self.index[message_id] = {
-            "id": message_id,
-            "content": message_content,
-            "parent_id": prev_message_id,
-            "child_ids": [],
-        }
+        self.index[message_id] = MessageNode(
+            message_id, message_content, prev_message_id
+        )
         if prev_message_id is None:
+            self.depth_since_summary[message_id] = 1
+            if self.root_message_id is None:  # The first message of a thread
+                self.root_message_id = message_id
             print("A new root node has been created")
             return
+        self.depth_since_summary[message_id] = (
+            self.depth_since_summary[prev_message_id] + 1
+        )
         print(
             f"A new message: {message_id} has been attached to message: {prev_message_id}"
         )
-        self.index[prev_message_id]["child_ids"].append(message_id)
+        self.index[prev_message_id].child_ids.append(message_id)
 
 
 class SummaryTree:
     # WIP: Requires mechanism to track root and branch selections
-    def __init__(self, message_tree: MessageTree, db: DB):
+    def __init__(
+        self,
+        message_tree: MessageTree,
+        db: DB,
+        bundle: Optional[ThreadBundleDTO] = None,
+    ):
 
         self._db = db  # Used to fetch summaries from db
         self.message_tree = message_tree  # Used to walk the tree
-        self.root_summary_id, self.index = self._load_index(self.message_tree.thread_id)
+        if bundle is None:
+            bundle = self._db.fetch_thread_bundle(self.message_tree.thread_id)
+        self.root_summary_id, self.index = self._load_index(bundle)
 
-    def _load_index(self, thread_id: int):
+    def _load_index(self, bundle: ThreadBundleDTO):
         """Loads the index for quick sunmmary traceability"""
 
         # Index components
@@ -106,109 +143,117 @@ class SummaryTree:
         start_message_lookup: dict[int, int] = {}
         end_message_lookup: dict[int, int] = {}
 
-        # Load compnents
-        summaries = self._db.fetch_summaries(thread_id)
-        for summary in summaries:
-            node: SummaryNode = {
-                "id": summary["id"],
-                "content": summary["content"],
-                "start_message_id": summary["start_message_id"],
-                "end_message_id": summary["end_message_id"],
-                "parent_id": None,
-                "child_ids": [],
-            }
-            id_lookup[summary["id"]] = node
-            start_message_lookup[summary["start_message_id"]] = summary["id"]
-            end_message_lookup[summary["end_message_id"]] = summary["id"]
-
-        # Map summaries
-        for summary in summaries:
-            # Find parent
-            parent_end_message_id = self.message_tree.index[
-                summary["start_message_id"]
-            ]["parent_id"]
-            if parent_end_message_id:
-                parent_id = end_message_lookup[parent_end_message_id]
-                id_lookup[summary["id"]]["parent_id"] = parent_id
-
-            # Find children
-            for child_start_message_id in self.message_tree.index[
-                summary["end_message_id"]
-            ]["child_ids"]:
-                if child_start_message_id not in start_message_lookup:
-                    continue
-                child_id = start_message_lookup[child_start_message_id]
-                id_lookup[summary["id"]]["child_ids"].append(child_id)
+        summarized_message_ids: set[int] = set()
+
+        # Load compnents, and mark the spanned messages
+        # Note: The parents are resolved by the database, so no message walk is needed
+        for summary in bundle["summaries"]:
+            summary_id = summary["id"]
+            start_message_id = summary["start_message_id"]
+            end_message_id = summary["end_message_id"]
+            id_lookup[summary_id] = SummaryNode(
+                summary_id,
+                summary["content"],
+                start_message_id,
+                end_message_id,
+                summary["parent_summary_id"],
+            )
+            start_message_lookup[start_message_id] = summary_id
+            end_message_lookup[end_message_id] = summary_id
+            summarized_message_ids.update(
+                self._span_message_ids(start_message_id, end_message_id)
+            )
+
+        # Map children. Note: A parent may be listed after its child
+        for node in id_lookup.values():
+            if node.parent_id is not None:
+                id_lookup[node.parent_id].child_ids.append(node.id)
+
+        # Reset unsummarized depths below every summary end
+        for end_message_id in end_message_lookup:
+            self._reset_depth_since_summary(end_message_id, end_message_lookup)
 
         # Intended: Will default to None, if the summary does not exist!
         root_summary_id = start_message_lookup.get(self.message_tree.root_message_id)
         return root_summary_id, SummaryIndex(
-            start_message_lookup, end_message_lookup, id_lookup
+            start_message_lookup, end_message_lookup, id_lookup, summarized_message_ids
         )
 
+    def _span_message_ids(
+        self, start_message_id: int, end_message_id: int
+    ) -> list[int]:
+        """
+        Lists the messages of a summary span.
+        Note: Walks up from the end, as a span is a linear chain of messages
+        """
+        message_ids = [end_message_id]
+        message_id = end_message_id
+        while message_id != start_message_id:
+            message_id = self.message_tree.index[message_id].parent_id
+            message_ids.append(message_id)
+        return message_ids
+
     def add_summary(
         self, summary_id: int, content: str, start_message_id: int, end_message_id: int
     ):
         """Adds summary to the summary tree, and the associated lookups"""
-        prev_summary_end_message_id = self.message_tree.index[start_message_id][
-            "parent_id"
-        ]
+        prev_summary_end_message_id = self.message_tree.index[
+            start_message_id
+        ].parent_id
         if prev_summary_end_message_id:
-            summary_parent = self.index.end_message_lookup[
-                self.message_tree.index[start_message_id]["parent_id"]
-            ]
+            summary_parent = self.index.end_message_lookup[prev_summary_end_message_id]
         else:
             summary_parent = None
 
-        summary: SummaryNode = {
-            "id": summary_id,
-            "content": content,
-            "start_message_id": start_message_id,
-            "end_message_id": end_message_id,
-            "parent_id": summary_parent,
-            "child_ids": [],
-        }
+        summary = SummaryNode(
+            summary_id, content, start_message_id, end_message_id, summary_parent
+        )
         if prev_summary_end_message_id is not None:
             prev_summary_id = self.index.end_message_lookup[prev_summary_end_message_id]
-            self.index.summary_id_lookup[prev_summary_id]["child_ids"].append(
-                summary_id
-            )
+            self.index.summary_id_lookup[prev_summary_id].child_ids.append(summary_id)
         self.index.summary_id_lookup[summary_id] = summary
+        if start_message_id == self.message_tree.root_message_id:
+            self.root_summary_id = summary_id
         self.index.start_message_lookup[start_message_id] = summary_id
         self.index.end_message_lookup[end_message_id] = summary_id
+        self.index.summarized_message_ids.update(
+            self._span_message_ids(start_message_id, end_message_id)
+        )
+        self._reset_depth_since_summary(end_message_id, self.index.end_message_lookup)
+
+    def _reset_depth_since_summary(
+        self, end_message_id: int, end_message_lookup: dict[int, int]
+    ):
+        """
+        Marks end_message_id as a summary end, in the message tree's depth counts.
+        Descendants are rebased onto it, down to the next summary ends.
+        """
+        depths = self.message_tree.depth_since_summary
+        offset = depths[end_message_id]
+        if offset == 0:  # Already a summary end
+            return
+        depths[end_message_id] = 0
+        message_ids = list(self.message_tree.index[end_message_id].child_ids)
+        while message_ids:
+            message_id = message_ids.pop()
+            if message_id in end_message_lookup:
+                continue
+            depths[message_id] -= offset
+            message_ids.extend(self.message_tree.index[message_id].child_ids)
 
     def count_unsummarized_messages(self, message_id: int):
         """
         Strictly assumes that message_id is either the end node of a summary,
         or message_id is yet to be summarized.
         """
-        count = 0
-        while (message_id is not None) and (
-            message_id not in self.index.end_message_lookup
-        ):
-            count += 1
-            message_id = self.message_tree.index[message_id]["parent_id"]
-        return count
+        return self.message_tree.depth_since_summary[message_id]
 
     def is_summarized(self, message_id: int) -> bool:
         """
         Determines if the message is already a part of a summary.
-        For this, if iterated forward, an end_message_id for a summary must be detected.
+        Note: A split keeps every message summarized, so only add_summary extends the set
         """
-        while True:
-            # Summary exists
-            if message_id in self.index.end_message_lookup:
-                return True
-            child_ids = self.message_tree.index[message_id]["child_ids"]
-            # After having run through the messages
-            if child_ids == []:
-                return False
-            # Within a summary, there can only be linear chain of messages.
-            # Even for non-summarized messages, a branch-off forces summary generation.
-            assert len(child_ids) == 1
-            message_id = child_ids[0]
-
-        # No returns. This must fail loudly
+        return message_id in self.index.summarized_message_ids
 
     def split_summary(
         self,
@@ -224,72 +269,105 @@ class SummaryTree:
         consisting of pre-and post of splitting at the branch_odd_message_id
         """
         summary = self.index.summary_id_lookup[summary_id]
+        # Relink the neighbours of the old summary
+        if summary.parent_id is not None:
+            siblings = self.index.summary_id_lookup[summary.parent_id].child_ids
+            siblings[siblings.index(summary_id)] = pre_summary_id
+        for child_id in summary.child_ids:
+            self.index.summary_id_lookup[child_id].parent_id = post_summary_id
+        if self.root_summary_id == summary_id:
+            self.root_summary_id = pre_summary_id
         # Delete summary from indices!
         del self.index.summary_id_lookup[summary_id]
-        del self.index.start_message_lookup[summary["start_message_id"]]
-        del self.index.end_message_lookup[summary["end_message_id"]]
+        del self.index.start_message_lookup[summary.start_message_id]
+        del self.index.end_message_lookup[summary.end_message_id]
         # create new summaries with old summary
-        pre_summary: SummaryNode = {
-            "id": pre_summary_id,
-            "content": pre_summary_content,
-            "parent_id": summary["parent_id"],
-            "start_message_id": summary["start_message_id"],
-            "end_message_id": branch_off_message_id,
-            "child_ids": [post_summary_id],
-        }
-        post_summary: SummaryNode = {
-            "id": post_summary_id,
-            "content": post_summary_content,
-            "parent_id": pre_summary_id,
+        pre_summary = SummaryNode(
+            id=pre_summary_id,
+            content=pre_summary_content,
+            parent_id=summary.parent_id,
+            start_message_id=summary.start_message_id,
+            end_message_id=branch_off_message_id,
+            child_ids=[post_summary_id],
+        )
+        post_summary = SummaryNode(
+            id=post_summary_id,
+            content=post_summary_content,
+            parent_id=pre_summary_id,
             # A summary consists of linear chain only, so the below statement is valid
-            "start_message_id": self.message_tree.index[branch_off_message_id][
-                "child_ids"
-            ][0],
-            "end_message_id": summary["end_message_id"],
-            "child_ids": summary["child_ids"],
-        }
+            start_message_id=self.message_tree.index[branch_off_message_id].child_ids[
+                0
+            ],
+            end_message_id=summary.end_message_id,
+            child_ids=summary.child_ids,
+        )
         # Add summary nodes to lookup indices
         self.index.summary_id_lookup[pre_summary_id] = pre_summary
         self.index.summary_id_lookup[post_summary_id] = post_summary
-        self.index.start_message_lookup[pre_summary["start_message_id"]] = (
-            pre_summary_id
+        self.index.start_message_lookup[pre_summary.start_message_id] = pre_summary_id
+        self.index.end_message_lookup[pre_summary.end_message_id] = pre_summary_id
+        self.index.start_message_lookup[post_summary.start_message_id] = post_summary_id
+        self.index.end_message_lookup[post_summary.end_message_id] = post_summary_id
+        self._reset_depth_since_summary(
+            branch_off_message_id, self.index.end_message_lookup
         )
-        self.index.end_message_lookup[pre_summary["end_message_id"]] = pre_summary_id
-        self.index.start_message_lookup[post_summary["start_message_id"]] = (
-            post_summary_id
-        )
-        self.index.end_message_lookup[post_summary["end_message_id"]] = post_summary_id
 
 
 class TreeCache:
     """LRU is a good policy to optimize long chat access"""
 
     def __init__(self, db: DB, max_capacity: int):
+        # Ordered from least to most recently used
         self.cache: OrderedDict[int, tuple[MessageTree, SummaryTree]] = OrderedDict()
         self.db = db
         self.max_capacity = max_capacity
-        self.curr_capacity = 0
+        # Guards the cache itself. The trees of a thread are guarded by its thread lock
+        self._lock = threading.Lock()
+        # Note: A lock is dropped once no caller holds it, so idle threads cost nothing
+        self._thread_locks: weakref.WeakValueDictionary[int, threading.Lock] = (
+            weakref.WeakValueDictionary()
+        )
+
+    def lock(self, thread_id: int) -> threading.Lock:
+        """
+        Returns the lock that serializes updates to the trees of a thread.
+        Shared by every handler on this cache
+        """
+        with self._lock:
+            thread_lock = self._thread_locks.get(thread_id)
+            if thread_lock is None:
+                thread_lock = self._thread_locks[thread_id] = threading.Lock()
+            return thread_lock
 
     def get(self, thread_id: int) -> tuple[MessageTree, SummaryTree]:
         """Implements LRU elimination"""
-        if self.cache.get(thread_id) is None:
-            if self.max_capacity == self.curr_capacity:
-                self.cache.popitem(last=True)  # Pop the last item in dict
-                self.curr_capacity -= 1
-
-            message_tree = MessageTree(thread_id, self.db)
-            summary_tree = SummaryTree(message_tree, self.db)
-
-            self.cache[thread_id] = (message_tree, summary_tree)
-            self.curr_capacity += 1
-            self.cache.move_to_end(thread_id, last=False)  # Move to front of dict
-
-        return self.cache[thread_id]
+        with self._lock:
+            trees = self.cache.get(thread_id)
+            if trees is not None:
+                self.cache.move_to_end(thread_id)  # Mark as most recently used
+                return trees
+
+        # A single round trip feeds both trees. Note: Built outside the lock
+        bundle = self.db.fetch_thread_bundle(thread_id)
+        message_tree = MessageTree(thread_id, self.db, bundle)
+        summary_tree = SummaryTree(message_tree, self.db, bundle)
+
+        with self._lock:
+            # Another caller may have built the trees meanwhile
+            trees = self.cache.setdefault(thread_id, (message_tree, summary_tree))
+            self.cache.move_to_end(thread_id)
+            if len(self.cache) > self.max_capacity:
+                self.cache.popitem(last=False)  # Evict the least recently used
+            return trees
 
     def delete(self, thread_id: int) -> None:
         """
         Deletes tree data from cache. Meant to trash invalid trees!
         Invalid trees are those, which are not in sync with the database
         """
-        if self.cache.get(thread_id) is not None:
-            del self.cache[thread_id]
+        with self._lock:
+            self.cache.pop(thread_id, None)
+
+    def __delitem__(self, thread_id: int) -> None:
+        """Supports `del tree_cache[thread_id]`, same as delete"""
+        self.delete(thread_id)
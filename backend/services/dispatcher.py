@@ -12,6 +12,9 @@ Else:
 TODO: More test cases, preferably full dummy test case of all options
 """
 
+import asyncio
+import threading
+from collections import deque
 from typing import Callable, Optional
 
 from services.chat_trees import TreeCache, SummaryTree, MessageTree
@@ -32,6 +35,15 @@ class Handler:
         self._tree_cache = tree_cache
         self._llm_ops = llm_ops
 
+    @property
+    def thread_local_db(self) -> bool:
+        """Whether the database is only visible to the thread that opened it"""
+        return self._db.thread_local
+
+    def lock(self, thread_id: int) -> threading.Lock:
+        """Returns the lock that serializes updates to a thread"""
+        return self._tree_cache.lock(thread_id)
+
     def add_message(
         self,
         content: str,
@@ -43,25 +55,99 @@ class Handler:
         """
         Inserts message and generate corresponding summary in memory tree and database
         """
-        # Database insertion
-        message_id = self._db.insert_message(thread_id, content)
-        # Insert the link to previous message
-        if prev_message_id is not None:
-            self._db.insert_link(
-                thread_id=thread_id,
-                prev_message_id=prev_message_id,
-                next_message_id=message_id,
-            )
-
-        # Load tree
+        # Load tree. Note: Before insertion, else a rebuilt tree already holds the message
         message_tree, _ = self._tree_cache.get(thread_id)
+
+        # Database insertion, along with the link to previous message
+        message_id, _ = self._db.insert_message_with_link(
+            thread_id, content, prev_message_id
+        )
         # Add message
         message_tree.add_message(message_id, content, prev_message_id)
 
         if trigger_summarization:  # Usually, the summary must be triggered
-            self._add_summary(thread_id, prev_message_id, content, summary_batch_size)
+            self._add_summary(
+                thread_id,
+                prev_message_id,
+                force=False,
+                message_content=content,
+                batch_size=summary_batch_size,
+            )
         return message_id
 
+    def update_summary(
+        self, thread_id: int, message_id: int, summary_batch_size: int
+    ) -> None:
+        """
+        Runs the summarization, that add_message skips when trigger_summarization is False.
+        Lets callers reply first, and summarize off the critical path
+        """
+        message_tree, _ = self._tree_cache.get(thread_id)
+        message = message_tree.index[message_id]
+        self._add_summary(
+            thread_id,
+            message.parent_id,
+            force=False,
+            message_content=message.content,
+            batch_size=summary_batch_size,
+        )
+
+    def add_messages(
+        self,
+        contents: list[str],
+        thread_id: int,
+        prev_message_id: Optional[int],
+        trigger_summarization: bool,
+        summary_batch_size: int,
+    ) -> list[int]:
+        """
+        Inserts a linear chain of messages below prev_message_id, in one transaction.
+        Summaries are generated as if the messages were added one by one
+        """
+        message_tree, _ = self._tree_cache.get(thread_id)
+
+        message_ids = self._db.bulk_insert_messages(
+            thread_id, contents, prev_message_id
+        )
+        prev_message_ids = [prev_message_id, *message_ids[:-1]]
+        for message_id, content, message_prev_id in zip(
+            message_ids, contents, prev_message_ids
+        ):
+            message_tree.add_message(message_id, content, message_prev_id)
+
+        if trigger_summarization:
+            for content, message_prev_id in zip(contents, prev_message_ids):
+                self._add_summary(
+                    thread_id,
+                    message_prev_id,
+                    force=False,
+                    message_content=content,
+                    batch_size=summary_batch_size,
+                )
+        return message_ids
+
+    def add_turn(
+        self,
+        user_content: str,
+        ai_content: str,
+        thread_id: int,
+        prev_message_id: Optional[int],
+        trigger_summarization: bool,
+        summary_batch_size: int,
+    ) -> tuple[int, int]:
+        """
+        Inserts a user message and its reply in one transaction.
+        Summaries are generated as if both messages were added one by one
+        """
+        user_message_id, ai_message_id = self.add_messages(
+            [user_content, ai_content],
+            thread_id,
+            prev_message_id,
+            trigger_summarization,
+            summary_batch_size,
+        )
+        return user_message_id, ai_message_id
+
     def _add_summary(
         self,
         thread_id: int,
@@ -100,29 +186,36 @@ class Handler:
                 )
                 or (
                     not self._llm_ops.detect_topic_shift(
-                        message_tree.index[prev_message_id]["content"], message_content
+                        message_tree.index[prev_message_id].content, message_content
                     )
                 )
             ):
                 return None
 
         # Accumulate summarizable content, and map the spanning nodes
-        summarizable_content: list[str] = []
+        # Note: Filled from the end, so appendleft keeps the chronological order
+        summarizable_content: deque[str] = deque()
         end_message_id = prev_message_id  # prev_message is a valid summarizable content
 
         # This will run atleast once! If not, something is wrong. Must fail loudly!
+        message_index = message_tree.index
+        end_message_lookup = summary_tree.index.end_message_lookup
         while (prev_message_id is not None) and (
-            prev_message_id not in summary_tree.index.end_message_lookup
+            prev_message_id not in end_message_lookup
         ):
             start_message_id = prev_message_id
-            message = message_tree.index[prev_message_id]
-            summarizable_content.append(message["content"])
-            prev_message_id = message["parent_id"]  # Update iterable
+            message = message_index[prev_message_id]
+            summarizable_content.appendleft(message.content)
+            prev_message_id = message.parent_id  # Update iterable
 
         # Generate summary and add to memory and db
         summarized_content = self._llm_ops.generate_summary(summarizable_content)
         summary_id = self._db.insert_summary(  # Add summary to database
-            summarized_content, start_message_id, end_message_id, embedding_file=None
+            summarized_content,
+            start_message_id,
+            end_message_id,
+            embedding_file=None,
+            thread_id=thread_id,
         )
         summary_tree.add_summary(  # Add summary to tree
             summary_id, summarized_content, start_message_id, end_message_id
@@ -156,83 +249,95 @@ class Handler:
             and an unsplit summary span is being split.
         """
         message_tree, summary_tree = self._tree_cache.get(thread_id)
-        ## Compute pre-summary data
-        pre_content, pre_start_message_id, pre_end_message_id = (
-            self._generate_split_pre_summary_data(
+        ## Collect pre-summary data
+        pre_contents, pre_start_message_id, pre_end_message_id = (
+            self._collect_split_pre_summary_data(
                 message_tree, summary_tree, branch_off_message_id
             )
         )
-        ## Compute post-summary data
-        post_content, post_start_message_id, post_end_message_id = (
-            self._generate_split_post_summary_data(
+        ## Collect post-summary data
+        post_contents, post_start_message_id, post_end_message_id = (
+            self._collect_split_post_summary_data(
                 message_tree, summary_tree, branch_off_message_id
             )
         )
-        ## Persist Split in Database
+        ## Generate both summaries concurrently
+        pre_content, post_content = self._llm_ops.generate_summaries(
+            [pre_contents, post_contents]
+        )
+        ## Persist Split in Database, in one transaction
         summary_id = summary_tree.index.start_message_lookup[pre_start_message_id]
-        self._db.delete_summary(summary_id)
-        pre_summary_id = self._db.insert_summary(
-            pre_content, pre_start_message_id, pre_end_message_id, embedding_file=None
+        pre_summary_id, post_summary_id = self._db.replace_summary(
+            summary_id,
+            [
+                (pre_content, pre_start_message_id, pre_end_message_id),
+                (post_content, post_start_message_id, post_end_message_id),
+            ],
+            thread_id=thread_id,
         )
-        post_summary_id = self._db.insert_summary(
+        ## Apply the split in memory, the cached trees stay valid
+        summary_tree.split_summary(
+            summary_id,
+            pre_summary_id,
+            pre_content,
+            branch_off_message_id,
+            post_summary_id,
             post_content,
-            post_start_message_id,
-            post_end_message_id,
-            embedding_file=None,
         )
-        # Invalidate cache, force rebuild tree.
-        self._tree_cache.delete(thread_id)
         return pre_summary_id, post_summary_id
 
-    def _generate_split_pre_summary_data(
+    def _collect_split_pre_summary_data(
         self,
         message_tree: MessageTree,
         summary_tree: SummaryTree,
         branch_off_message_id: int,
-    ) -> tuple[str, int, int]:
+    ) -> tuple[deque[str], int, int]:
         """
-        Supporting method which generates pre-split point summary data.
+        Supporting method which collects pre-split point summary data.
         """
-        contents = []
+        contents: deque[str] = deque()
         pre_start_message_id = pre_end_message_id = message_id = branch_off_message_id
 
         # Iterate in reverse tracking parent id, until the previous summary is reached.
         # Note: A start message will always exist for a summary. Checking not required
-        while message_id not in summary_tree.index.start_message_lookup:
-            contents.append(message_tree.index[message_id]["content"])
-            message_id = message_tree.index[message_id]["parent_id"]
+        message_index = message_tree.index
+        start_message_lookup = summary_tree.index.start_message_lookup
+        message = message_index[message_id]
+        while message_id not in start_message_lookup:
+            contents.appendleft(message.content)
+            message_id = message.parent_id
+            message = message_index[message_id]
         # Set start-message and its contents
         pre_start_message_id = message_id
-        contents.append(message_tree.index[message_id]["content"])
-        # Generate pre-summary content
-        contents.reverse()  # Note: because of reverse traversal
-        pre_content = self._llm_ops.generate_summary(contents)
-        return pre_content, pre_start_message_id, pre_end_message_id
+        contents.appendleft(message.content)  # Note: because of reverse traversal
+        return contents, pre_start_message_id, pre_end_message_id
 
-    def _generate_split_post_summary_data(
+    def _collect_split_post_summary_data(
         self,
         message_tree: MessageTree,
         summary_tree: SummaryTree,
         branch_off_message_id: int,
-    ) -> tuple[str, int, int]:
+    ) -> tuple[list[str], int, int]:
         """
-        Supporting method which generates post-split point summary data.
+        Supporting method which collects post-split point summary data.
         """
         contents = []
-        post_start_message_id = post_end_message_id = message_id = message_tree.index[
+        message_index = message_tree.index
+        end_message_lookup = summary_tree.index.end_message_lookup
+        post_start_message_id = post_end_message_id = message_id = message_index[
             branch_off_message_id
-        ]["child_ids"][0]
-        while message_id not in summary_tree.index.end_message_lookup:
-            contents.append(message_tree.index[message_id]["content"])
+        ].child_ids[0]
+        message = message_index[message_id]
+        while message_id not in end_message_lookup:
+            contents.append(message.content)
             post_end_message_id = message_id
             # Note: A summary always contains a linear chain of messages
-            message_id = message_tree.index[message_id]["child_ids"][0]
+            message_id = message.child_ids[0]
+            message = message_index[message_id]
         # Set end-message and its contents
         post_end_message_id = message_id
-        contents.append(message_tree.index[message_id]["content"])
-        # generate post-summary
-        post_content = self._llm_ops.generate_summary(contents)
-        return post_content, post_start_message_id, post_end_message_id
+        contents.append(message.content)
+        return contents, post_start_message_id, post_end_message_id
 
     def delete_branch(self, thread_id: int, branch_start_message_id: int) -> None:
         """
@@ -243,8 +348,9 @@ class Handler:
         """
         message_tree, summary_tree = self._tree_cache.get(thread_id)
 
-        self._delete_branch_messages(message_tree, branch_start_message_id)
+        # Note: Summaries go first, as they reference the messages
         self._delete_branch_summaries(summary_tree, branch_start_message_id)
+        self._delete_branch_messages(message_tree, branch_start_message_id)
 
         # The deletions invalidate trees, so force reconstruction from db
         self._tree_cache.delete(thread_id)
@@ -253,26 +359,18 @@ class Handler:
         self, message_tree: MessageTree, branch_start_message_id: int
     ):
         """
-        Chain deletes messages of a branch from database
+        Deletes messages of a branch from database, along with their links.
+        Note: The branch is collected from the in-memory tree, then deleted in one transaction
         """
-        branch_off_message_id = message_tree.index[branch_start_message_id]["parent"]
-
-        # Detach branch_start_message from branch_off_message.
-        if branch_off_message_id is not None:
-            self._db.delete_link(branch_off_message_id, branch_start_message_id)
-
-        # Delete remaining messages in branch
+        message_index = message_tree.index
+        branch_message_ids: list[int] = []
         message_ids: list[int] = [branch_start_message_id]
         while message_ids:
             message_id = message_ids.pop()
-            child_ids = message_tree.index[message_id]["child_ids"]
-            # Add children for future exploration
-            message_ids.extend(child_ids)
-            # Detach current node from children
-            for child_id in child_ids:
-                self._db.delete_link(message_id, child_id)
-            # Delete the current node
-            self._db.delete_message(message_id)
+            branch_message_ids.append(message_id)
+            message_ids.extend(message_index[message_id].child_ids)
+        # Also detaches branch_start_message from branch_off_message
+        self._db.delete_messages(branch_message_ids, thread_id=message_tree.thread_id)
 
     def _delete_branch_summaries(
         self, summary_tree: SummaryTree, branch_start_message_id: int
@@ -288,12 +386,16 @@ class Handler:
         # Note: Summary tree is derived from message tree, no deletion of links necessary
 
         # Delete summaries from db
+        summary_id_lookup = summary_tree.index.summary_id_lookup
+        branch_summary_ids: list[int] = []
         summary_ids: list[int] = [branch_start_summary_id]
         while summary_ids:
             summary_id = summary_ids.pop()
-            self._db.delete_summary(summary_id)
-            summary = summary_tree.index.summary_id_lookup[summary_id]
-            summary_ids.extend(summary["child_ids"])
+            branch_summary_ids.append(summary_id)
+            summary_ids.extend(summary_id_lookup[summary_id].child_ids)
+        self._db.delete_summaries(
+            branch_summary_ids, thread_id=summary_tree.message_tree.thread_id
+        )
 
 
 class ChatUpdateDispatcher:
@@ -306,6 +408,9 @@ class ChatUpdateDispatcher:
         # Action registry
         self.handlers: dict[str, Callable[[dict], dict]] = {
             "add_message": self._handler.add_message,
+            "add_messages": self._handler.add_messages,
+            "add_turn": self._handler.add_turn,
+            "update_summary": self._handler.update_summary,
             "branch_off": self._handler.branch_off,
             "delete_branch": self._handler.delete_branch,
             # delete any subtree | delete any message
@@ -316,7 +421,26 @@ class ChatUpdateDispatcher:
         Routes chat update actions to the correct handler.
         Payload must match the expected kwargs for the selected handler.
         """
-        if action not in self.handlers:
-            raise ValueError(f"Unsupported update type: {action}")
-        handler = self.handlers[action]
-        return handler(**payload)
+        try:
+            handler = self.handlers[action]
+        except KeyError:
+            raise ValueError(f"Unsupported update type: {action}") from None
+        # Updates of a thread run one at a time, as its cached trees are not thread-safe
+        with self._handler.lock(payload.get("thread_id")):
+            return handler(**payload)
+
+    async def adispatch(self, action: str, payload: dict) -> dict:
+        """
+        Async variant of dispatch.
+        The handler runs in a worker thread, so its DB and LLM waits do not block the event loop.
+        Updates of different threads overlap, while those of one thread still run in order.
+
+        Note: The workers need a database shared across threads.
+        A plain in-memory SQLite database is private to the thread that opened it
+        """
+        if self._handler.thread_local_db:
+            raise RuntimeError(
+                "adispatch needs a database shared across threads. "
+                "Use a file or shared-cache SQLite URI, instead of sqlite:///:memory:"
+            )
+        return await asyncio.to_thread(self.dispatch, action, payload)
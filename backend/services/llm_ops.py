@@ -1,33 +1,90 @@
-import json
-from typing import Optional
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Sequence
 
+import orjson
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 
 from db.models import Message
 
+RESPONSE_CACHE_SIZE = 4096  # Count of remembered LLM verdicts and summaries
+
+
+def llm_concurrency() -> int:
+    """
+    Caps the concurrent requests of one batched call, and of the async calls of one client.
+    Note: Sync single calls are bounded by the threads of their callers
+    """
+    return int(os.getenv("LLM_CONCURRENCY", "8"))
+
+
+@lru_cache(maxsize=None)
+def _load_prompt(path: str) -> str:
+    """Reads a prompt file once, and serves later calls from memory"""
+    with open(path, "r") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def _system_message(path: str) -> SystemMessage:
+    """
+    Builds the system message of a prompt file once.
+    Note: Shared across calls, so it must not be mutated
+    """
+    return SystemMessage(content=_load_prompt(path))
+
 
 class LLMOps:
-    def __init__(self, llm: ChatOpenAI):
+    def __init__(self, llm: ChatOpenAI, topic_shift_llm: Optional[ChatOpenAI] = None):
         self._llm = llm
+        # A yes/no verdict rarely needs the full model; defaults to the main LLM
+        self._topic_shift_llm = topic_shift_llm or llm
+        # Bounds the concurrent requests of async calls, and of each batch
+        self._max_concurrency = llm_concurrency()
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        # LRU caches of LLM results, keyed on the exact prompt inputs
+        self._topic_shift_cache: OrderedDict[tuple[str, str], bool] = OrderedDict()
+        self._summary_cache: OrderedDict[tuple[str, ...], str] = OrderedDict()
+        # Note: Dispatches of different threads share the caches from worker threads
+        self._cache_lock = threading.Lock()
+
+    def _cache_get(self, cache: OrderedDict, key):
+        """Returns the cached value, or None. A hit marks the key as most recently used"""
+        with self._cache_lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, cache: OrderedDict, key, value):
+        with self._cache_lock:
+            cache[key] = value
+            if len(cache) > RESPONSE_CACHE_SIZE:
+                cache.popitem(last=False)
+            return value
 
     def group(self, messages: list[Message]) -> list[list[Message]]:
         """Groups Messages such that they each group can form coherent summaries"""
-        with open("prompts/group_policy.txt", "r") as f:
-            system_prompt = f.read()
         # Refer system prompt
         human_prompt = "\n".join(
             [f"{i}. {message.content}" for i, message in enumerate(messages)]
         )
         raw_response = self._llm.invoke(
-            [SystemMessage(content=system_prompt), HumanMessage(content=human_prompt)]
+            [
+                _system_message("prompts/group_policy.txt"),
+                HumanMessage(content=human_prompt),
+            ]
         ).content
         try:
-            groups = json.loads(raw_response)
+            groups = orjson.loads(raw_response)
             result = []
             for group in groups:
                 result.append([messages[i] for i in group])
-        except json.JSONDecodeError as exc:
+        except orjson.JSONDecodeError as exc:  # Note: Subclasses json.JSONDecodeError
             raise ValueError(
                 f"Failed to parse reponse into JSON formation: Raw output: {raw_response}"
             ) from exc
@@ -43,34 +100,120 @@ class LLMOps:
             )
             return False
 
-        with open("prompts/topic_shift_detection.txt", "r") as f:
-            system_prompt = f.read()
+        shift = self._cache_get(self._topic_shift_cache, (prev_msg, new_msg))
+        if shift is not None:
+            return shift
+        result = self._topic_shift_llm.invoke(
+            self._topic_shift_prompt(prev_msg, new_msg)
+        )
+        return self._cache_put(
+            self._topic_shift_cache,
+            (prev_msg, new_msg),
+            self._is_topic_shift(result.content),
+        )
+
+    async def adetect_topic_shift(self, prev_msg: Optional[str], new_msg: str) -> bool:
+        """
+        Async variant of detect_topic_shift.
+        Lets the check overlap with other I/O, such as the response generation.
+        """
+        if prev_msg is None:
+            return False
+
+        shift = self._cache_get(self._topic_shift_cache, (prev_msg, new_msg))
+        if shift is not None:
+            return shift
+        async with self._semaphore:
+            result = await self._topic_shift_llm.ainvoke(
+                self._topic_shift_prompt(prev_msg, new_msg)
+            )
+        return self._cache_put(
+            self._topic_shift_cache,
+            (prev_msg, new_msg),
+            self._is_topic_shift(result.content),
+        )
+
+    def detect_topic_shifts(self, pairs: list[tuple[Optional[str], str]]) -> list[bool]:
+        """
+        Detects topic shifts for many (previous, current) message pairs.
+        The LLM calls run concurrently, so the wall time is that of the slowest call.
+        """
+        shifts = [False] * len(pairs)
+        positions = []
+        for i, pair in enumerate(pairs):
+            if pair[0] is None:  # Pairs without a previous message cannot shift topic
+                continue
+            shift = self._cache_get(self._topic_shift_cache, pair)
+            if shift is None:
+                positions.append(i)
+            else:
+                shifts[i] = shift
+        if not positions:
+            return shifts
+        results = self._topic_shift_llm.batch(
+            [self._topic_shift_prompt(*pairs[i]) for i in positions],
+            config={"max_concurrency": self._max_concurrency},
+        )
+        for i, result in zip(positions, results):
+            shifts[i] = self._cache_put(
+                self._topic_shift_cache,
+                tuple(pairs[i]),
+                self._is_topic_shift(result.content),
+            )
+        return shifts
+
+    @staticmethod
+    def _topic_shift_prompt(prev_msg: str, new_msg: str) -> list[BaseMessage]:
         # Refer system prompt
         human_prompt = "\n".join(
             ["Previous Message:", prev_msg, "Current Message:", new_msg]
         )
+        return [
+            _system_message("prompts/topic_shift_detection.txt"),
+            HumanMessage(content=human_prompt),
+        ]
 
-        result = (
-            self._llm.invoke(
-                [
-                    SystemMessage(content=system_prompt),
-                    HumanMessage(content=human_prompt),
-                ]
-            )
-            .content.strip()
-            .lower()
-        )
-        return result.startswith("y")
+    @staticmethod
+    def _is_topic_shift(response: str) -> bool:
+        # Only the first character decides; avoids copying the whole reply
+        return response.lstrip()[:1] in ("y", "Y")
 
-    def generate_summary(self, contents: list[str]) -> str:
+    def generate_summary(self, contents: Sequence[str]) -> str:
         """A simple prompt to generate summaries for a given list of strings"""
-        with open("prompts/summary_generation.txt", "r") as f:
-            system_prompt = f.read()
+        key = tuple(contents)
+        summary = self._cache_get(self._summary_cache, key)
+        if summary is not None:
+            return summary
+        summary = self._llm.invoke(self._summary_prompt(contents)).content.strip()
+        return self._cache_put(self._summary_cache, key, summary)
+
+    def generate_summaries(self, batches: list[Sequence[str]]) -> list[str]:
+        """
+        Generates a summary for each list of strings.
+        The LLM calls run concurrently, so the wall time is that of the slowest call.
+        """
+        keys = [tuple(contents) for contents in batches]
+        summaries = [self._cache_get(self._summary_cache, key) for key in keys]
+        positions = [i for i, summary in enumerate(summaries) if summary is None]
+        if not positions:
+            return summaries
+        results = self._llm.batch(
+            [self._summary_prompt(batches[i]) for i in positions],
+            config={"max_concurrency": self._max_concurrency},
+        )
+        for i, result in zip(positions, results):
+            summaries[i] = self._cache_put(
+                self._summary_cache, keys[i], result.content.strip()
+            )
+        return summaries
+
+    @staticmethod
+    def _summary_prompt(contents: Sequence[str]) -> list[BaseMessage]:
         # Refer system prompt
         human_prompt = "\n".join(
-            ["Messages:", *[f"{i+1}. {content}" for i, content in enumerate(contents)]]
+            ["Messages:", *(f"{i}. {content}" for i, content in enumerate(contents, 1))]
         )
-
-        return self._llm.invoke(
-            [SystemMessage(content=system_prompt), HumanMessage(content=human_prompt)]
-        ).content.strip()
+        return [
+            _system_message("prompts/summary_generation.txt"),
+            HumanMessage(content=human_prompt),
+        ]
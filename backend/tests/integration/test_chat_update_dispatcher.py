@@ -5,22 +5,46 @@ Test Coverage:
 1. Message insertion into message_tree
     a. With summary generation triggered
     b. Without summary generation
+    c. A user message and its reply, as one turn
+    d. With summary generation deferred
+    e. An identical sibling is inserted, as a new branch
+    f. A chain of messages, in one transaction
 2. Summary generation behavior:
     a. Ensures minimum message count is respected
     b. Triggered only upon topic shift
 3. Summary integrity:
     a. Summaries span correct message IDs
     b. Summary tree accurately reflects message tree state
+    c. Summaries are generated from messages in chronological order
 4. Summary splitting:
     a. Old summary is replaced by two new ones
     b. Summary span is correctly split across message IDs
+5. Branch deletion removes the branch's messages, links and summaries
+6. Async dispatch runs handlers off the event loop
+    a. Updates of different threads run concurrently
+    b. Updates of one thread run one at a time
+    c. A thread-local in-memory database is rejected
 """
 
+import asyncio
+import re
+import threading
+import time
+import uuid
+
 import pytest
 
 from db.db import DB
 from services.dispatcher import Handler, ChatUpdateDispatcher
-from services.chat_trees import TreeCache
+from services.chat_trees import MessageTree, SummaryTree, TreeCache
+
+# (content, prev_message_id): a chain of 3 with a fork off message 2
+FORKED_CHAIN = (
+    ("new Message A", None),
+    ("new Message B", 1),
+    ("new Message C", 2),
+    ("new Message D", 2),
+)
 
 
 @pytest.fixture
@@ -36,14 +60,20 @@ class DummyLLMOps:
     """
     Dummy class for mocking LLM operations during testing.
     - `generate_summary`: returns dummy text based on number of messages.
+    - `generate_summaries`: applies `generate_summary` to each batch.
     - `detect_topic_shift`: returns True if the current message contains "new".
     """
 
+    _TRIGGER = re.compile("new", re.IGNORECASE)
+
     def generate_summary(self, contents):
         return f"Summary({len(contents)} messages)"
 
+    def generate_summaries(self, batches):
+        return [self.generate_summary(contents) for contents in batches]
+
     def detect_topic_shift(self, prev, curr):
-        return "new" in curr.lower()
+        return self._TRIGGER.search(curr) is not None
 
 
 @pytest.fixture
@@ -54,7 +84,15 @@ def tree_cache(db):
     return TreeCache(db, 2)
 
 
-def test_dispatcher_add_message(db, tree_cache):
+@pytest.fixture
+def chat_dispatcher(db, tree_cache):
+    """
+    ChatUpdateDispatcher wired to the test db, tree_cache and DummyLLMOps.
+    """
+    return ChatUpdateDispatcher(Handler(db, tree_cache, DummyLLMOps()))
+
+
+def test_dispatcher_add_message(db, tree_cache, chat_dispatcher):
     """
     Validates message insertion and tree reconstruction.
     - Ensures parent-child links are correctly created in the message tree.
@@ -62,8 +100,6 @@ def test_dispatcher_add_message(db, tree_cache):
     """
 
     thread_id = db.insert_thread()
-    handler = Handler(db, tree_cache, DummyLLMOps())
-    chat_dispatcher = ChatUpdateDispatcher(handler)
 
     # Insert 3 messages; summary should trigger after 2nd message due to batch size.
     chat_dispatcher.dispatch(
@@ -100,84 +136,225 @@ def test_dispatcher_add_message(db, tree_cache):
     message_tree, summary_tree = tree_cache.get(thread_id)
 
     # Message tree structure
-    assert message_tree.index[1]["child_ids"] == [2]
-    assert message_tree.index[2]["child_ids"] == [3]
-    assert message_tree.index[2]["parent_id"] == 1
-    assert message_tree.index[3]["parent_id"] == 2
+    assert message_tree.index[1].child_ids == [2]
+    assert message_tree.index[2].child_ids == [3]
+    assert message_tree.index[2].parent_id == 1
+    assert message_tree.index[3].parent_id == 2
 
     # Summary spans messages 1-2
-    assert summary_tree.index.summary_id_lookup[1]["start_message_id"] == 1
-    assert summary_tree.index.summary_id_lookup[1]["end_message_id"] == 2
+    assert summary_tree.index.summary_id_lookup[1].start_message_id == 1
+    assert summary_tree.index.summary_id_lookup[1].end_message_id == 2
 
 
-def test_dispatcher_add_summary(db, tree_cache):
+def test_dispatcher_add_message_identical_sibling(db, tree_cache, chat_dispatcher):
     """
-    Tests summary generation based on batch size and topic shift.
-    - Ensures summary is only generated when enough messages have accumulated.
-    - Verifies tree structure integrity when branching occurs.
+    Validates that re-asking a message on a new branch inserts a new message,
+    even though its content matches the existing child.
+    """
+    thread_id = db.insert_thread()
+    payload = {
+        "thread_id": thread_id,
+        "trigger_summarization": False,
+        "summary_batch_size": 1,
+    }
+
+    a = chat_dispatcher.dispatch(
+        "add_message", {"content": "Message A", "prev_message_id": None, **payload}
+    )
+    b = chat_dispatcher.dispatch(
+        "add_message", {"content": "Message B", "prev_message_id": a, **payload}
+    )
+    chat_dispatcher.dispatch(
+        "branch_off", {"thread_id": thread_id, "branch_off_message_id": a}
+    )
+    c = chat_dispatcher.dispatch(
+        "add_message", {"content": "Message B", "prev_message_id": a, **payload}
+    )
+
+    assert c != b
+    message_tree, _ = tree_cache.get(thread_id)
+    assert message_tree.index[a].child_ids == [b, c]
+    assert len(db.fetch_messages(thread_id)) == 3
+
+
+def test_dispatcher_add_messages(db, tree_cache, chat_dispatcher):
     """
+    Validates that a bulk chain summarizes like single insertions.
 
+    Structure:
+        [A → B] → C → D
+    """
     thread_id = db.insert_thread()
-    handler = Handler(db, tree_cache, DummyLLMOps())
-    chat_dispatcher = ChatUpdateDispatcher(handler)
 
-    # Insert 4 messages: 3 in a chain, 1 as branch off the 2nd
-    chat_dispatcher.dispatch(
-        "add_message",
+    a, b, c, d = chat_dispatcher.dispatch(
+        "add_messages",
         {
-            "content": "new Message A",
+            "contents": ["Message A", "Message B", "new Message C", "Message D"],
             "thread_id": thread_id,
             "prev_message_id": None,
             "trigger_summarization": True,
-            "summary_batch_size": 2,
+            "summary_batch_size": 1,
         },
     )
-    chat_dispatcher.dispatch(
-        "add_message",
+
+    message_tree, summary_tree = tree_cache.get(thread_id)
+    assert [message_tree.index[m].parent_id for m in (b, c, d)] == [a, b, c]
+    assert len(summary_tree.index.summary_id_lookup) == 1
+    summary = summary_tree.index.summary_id_lookup[1]
+    assert (summary.start_message_id, summary.end_message_id) == (a, b)
+
+
+def test_dispatcher_add_turn(db, tree_cache, chat_dispatcher):
+    """
+    Validates that a turn chains both messages, and summarizes like single insertions.
+
+    Structure:
+        [A → B] → C → D
+    """
+    thread_id = db.insert_thread()
+
+    turn = {
+        "thread_id": thread_id,
+        "trigger_summarization": True,
+        "summary_batch_size": 1,
+    }
+    a, b = chat_dispatcher.dispatch(
+        "add_turn",
         {
-            "content": "new Message B",
-            "thread_id": thread_id,
-            "prev_message_id": 1,
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
+            "user_content": "Message A",
+            "ai_content": "Message B",
+            "prev_message_id": None,
+            **turn,
         },
     )
-    chat_dispatcher.dispatch(
-        "add_message",
+    c, d = chat_dispatcher.dispatch(
+        "add_turn",
         {
-            "content": "new Message C",
-            "thread_id": thread_id,
-            "prev_message_id": 2,
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
+            "user_content": "new Message C",
+            "ai_content": "Message D",
+            "prev_message_id": b,
+            **turn,
         },
     )
+
+    message_tree, summary_tree = tree_cache.get(thread_id)
+    assert message_tree.index[a].child_ids == [b]
+    assert message_tree.index[b].child_ids == [c]
+    assert message_tree.index[c].child_ids == [d]
+
+    # Only the topic shift at C triggers a summary
+    assert len(summary_tree.index.summary_id_lookup) == 1
+    summary = summary_tree.index.summary_id_lookup[1]
+    assert (summary.start_message_id, summary.end_message_id) == (a, b)
+
+
+def test_dispatcher_update_summary(db, tree_cache, chat_dispatcher):
+    """
+    Validates that a deferred summarization matches a triggered one.
+
+    Structure:
+        [A → B] → C
+    """
+    thread_id = db.insert_thread()
+
+    prev_message_id = None
+    for content in ["Message A", "Message B", "new Message C"]:
+        prev_message_id = chat_dispatcher.dispatch(
+            "add_message",
+            {
+                "content": content,
+                "thread_id": thread_id,
+                "prev_message_id": prev_message_id,
+                "trigger_summarization": False,
+                "summary_batch_size": 1,
+            },
+        )
+    _, summary_tree = tree_cache.get(thread_id)
+    assert not summary_tree.index.summary_id_lookup
+
     chat_dispatcher.dispatch(
-        "add_message",
+        "update_summary",
         {
-            "content": "new Message D",
             "thread_id": thread_id,
-            "prev_message_id": 2,  # Fork from message 2
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
+            "message_id": prev_message_id,
+            "summary_batch_size": 1,
         },
     )
 
+    summary = summary_tree.index.summary_id_lookup[1]
+    assert (summary.start_message_id, summary.end_message_id) == (1, 2)
+
+
+def test_dispatcher_add_summary(db, tree_cache, chat_dispatcher):
+    """
+    Tests summary generation based on batch size and topic shift.
+    - Ensures summary is only generated when enough messages have accumulated.
+    - Verifies tree structure integrity when branching occurs.
+    """
+
+    thread_id = db.insert_thread()
+
+    # Insert 4 messages: 3 in a chain, 1 as branch off the 2nd
+    for content, prev_message_id in FORKED_CHAIN:
+        chat_dispatcher.dispatch(
+            "add_message",
+            {
+                "content": content,
+                "thread_id": thread_id,
+                "prev_message_id": prev_message_id,
+                "trigger_summarization": True,
+                "summary_batch_size": 2,
+            },
+        )
+
     message_tree, summary_tree = tree_cache.get(thread_id)
 
     # Message tree integrity
-    assert message_tree.index[1]["child_ids"] == [2]
-    assert message_tree.index[2]["child_ids"] == [3, 4]
-    assert message_tree.index[2]["parent_id"] == 1
-    assert message_tree.index[3]["parent_id"] == 2
-    assert message_tree.index[4]["parent_id"] == 2
+    assert message_tree.index[1].child_ids == [2]
+    assert message_tree.index[2].child_ids == [3, 4]
+    assert message_tree.index[2].parent_id == 1
+    assert message_tree.index[3].parent_id == 2
+    assert message_tree.index[4].parent_id == 2
 
     # Summary spans messages 1–2
-    assert summary_tree.index.summary_id_lookup[1]["start_message_id"] == 1
-    assert summary_tree.index.summary_id_lookup[1]["end_message_id"] == 2
+    assert summary_tree.index.summary_id_lookup[1].start_message_id == 1
+    assert summary_tree.index.summary_id_lookup[1].end_message_id == 2
 
 
-def test_dispatcher_split_summary(db, tree_cache):
+def test_dispatcher_summary_content_order(db, tree_cache):
+    """
+    Validates that the summarized contents are passed oldest first.
+    """
+
+    class RecordingLLMOps(DummyLLMOps):
+        def __init__(self):
+            self.summarized = []
+
+        def generate_summary(self, contents):
+            self.summarized.append(list(contents))
+            return super().generate_summary(contents)
+
+    thread_id = db.insert_thread()
+    llm_ops = RecordingLLMOps()
+    chat_dispatcher = ChatUpdateDispatcher(Handler(db, tree_cache, llm_ops))
+
+    prev_message_id = None
+    for content in ["Message A", "Message B", "Message C", "new Message D"]:
+        prev_message_id = chat_dispatcher.dispatch(
+            "add_message",
+            {
+                "content": content,
+                "thread_id": thread_id,
+                "prev_message_id": prev_message_id,
+                "trigger_summarization": True,
+                "summary_batch_size": 3,
+            },
+        )
+
+    assert llm_ops.summarized == [["Message A", "Message B", "Message C"]]
+
+
+def test_dispatcher_split_summary(db, tree_cache, chat_dispatcher):
     """
     Validates the behavior of `split_summary`.
     - Confirms that an existing summary is split correctly into two summaries.
@@ -185,71 +362,223 @@ def test_dispatcher_split_summary(db, tree_cache):
     """
 
     thread_id = db.insert_thread()
-    handler = Handler(db, tree_cache, DummyLLMOps())
-    chat_dispatcher = ChatUpdateDispatcher(handler)
 
     # Build initial summary
-    chat_dispatcher.dispatch(
-        "add_message",
-        {
-            "content": "new Message A",
-            "thread_id": thread_id,
-            "prev_message_id": None,
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
-        },
-    )
-    chat_dispatcher.dispatch(
-        "add_message",
-        {
-            "content": "new Message B",
-            "thread_id": thread_id,
-            "prev_message_id": 1,
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
-        },
-    )
-    chat_dispatcher.dispatch(
-        "add_message",
-        {
-            "content": "new Message C",
-            "thread_id": thread_id,
-            "prev_message_id": 2,
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
-        },
-    )
-    chat_dispatcher.dispatch(
-        "add_message",
-        {
-            "content": "new Message D",
-            "thread_id": thread_id,
-            "prev_message_id": 2,
-            "trigger_summarization": True,
-            "summary_batch_size": 2,
-        },
-    )
+    for content, prev_message_id in FORKED_CHAIN:
+        chat_dispatcher.dispatch(
+            "add_message",
+            {
+                "content": content,
+                "thread_id": thread_id,
+                "prev_message_id": prev_message_id,
+                "trigger_summarization": True,
+                "summary_batch_size": 2,
+            },
+        )
 
     # Pre-split assertions
     message_tree, summary_tree = tree_cache.get(thread_id)
-    assert summary_tree.index.summary_id_lookup[1]["start_message_id"] == 1
-    assert summary_tree.index.summary_id_lookup[1]["end_message_id"] == 2
+    assert summary_tree.index.summary_id_lookup[1].start_message_id == 1
+    assert summary_tree.index.summary_id_lookup[1].end_message_id == 2
 
     # Perform the split
     chat_dispatcher.dispatch(
         "branch_off", {"thread_id": thread_id, "branch_off_message_id": 1}
     )
 
-    # Post-split validation
-    message_tree, summary_tree = tree_cache.get(thread_id)
+    # Post-split validation, the cached trees are updated in place
+    assert tree_cache.get(thread_id)[1] is summary_tree
     assert (
         3 not in summary_tree.index.summary_id_lookup
     )  # old summary should not be reused
-    assert summary_tree.index.summary_id_lookup[1]["start_message_id"] == 1
-    assert summary_tree.index.summary_id_lookup[1]["end_message_id"] == 1
-    assert summary_tree.index.summary_id_lookup[2]["start_message_id"] == 2
-    assert summary_tree.index.summary_id_lookup[2]["end_message_id"] == 2
+    assert summary_tree.index.summary_id_lookup[1].start_message_id == 1
+    assert summary_tree.index.summary_id_lookup[1].end_message_id == 1
+    assert summary_tree.index.summary_id_lookup[2].start_message_id == 2
+    assert summary_tree.index.summary_id_lookup[2].end_message_id == 2
+
+    # The in-place split must leave the same trees as a rebuild from the database
+    bundle = db.fetch_thread_bundle(thread_id)
+    rebuilt_summary_tree = SummaryTree(MessageTree(thread_id, db, bundle), db, bundle)
+    assert summary_tree.root_summary_id == rebuilt_summary_tree.root_summary_id
+    assert summary_tree.index == rebuilt_summary_tree.index
+    assert (
+        message_tree.root_message_id
+        == rebuilt_summary_tree.message_tree.root_message_id
+    )
+    assert (
+        message_tree.depth_since_summary
+        == rebuilt_summary_tree.message_tree.depth_since_summary
+    )
 
 
 ## TODO: Test for branch-off with and without summaries
 ## TODO: Test for message-deletion
+
+
+def test_dispatcher_delete_branch(db, tree_cache, chat_dispatcher):
+    """
+    Validates that a branch is deleted, and the rest of the thread is kept.
+
+    Structure:
+        A → B → C
+             ↘ [D → E]  (deleted)
+    """
+    thread_id = db.insert_thread()
+    a, b, c = db.bulk_insert_messages(thread_id, ["A", "B", "C"])
+    d, e = db.bulk_insert_messages(thread_id, ["D", "E"], prev_message_id=b)
+    db.insert_summary("Summary DE", d, e, None)
+
+    chat_dispatcher.dispatch(
+        "delete_branch", {"thread_id": thread_id, "branch_start_message_id": d}
+    )
+
+    message_tree, summary_tree = tree_cache.get(thread_id)
+    assert set(message_tree.index) == {a, b, c}
+    assert message_tree.index[b].child_ids == [c]
+    assert not summary_tree.index.summary_id_lookup
+    links = {
+        (link["previous_message_id"], link["next_message_id"])
+        for link in db.fetch_links(thread_id)
+    }
+    assert links == {(a, b), (b, c)}
+
+
+def test_dispatcher_adispatch():
+    """
+    Validates async dispatch against a shared-cache in-memory database,
+    as handlers run in worker threads.
+    Note: A plain in-memory SQLite database is private to the thread that opened it
+    """
+    db = DB(f"sqlite:///file:{uuid.uuid4().hex}?mode=memory&cache=shared&uri=true")
+    tree_cache = TreeCache(db, 2)
+    thread_id = db.insert_thread()
+    chat_dispatcher = ChatUpdateDispatcher(Handler(db, tree_cache, DummyLLMOps()))
+
+    async def add_messages():
+        message_ids = []
+        prev_message_id = None
+        for content in ["Message A", "Message B"]:
+            prev_message_id = await chat_dispatcher.adispatch(
+                "add_message",
+                {
+                    "content": content,
+                    "thread_id": thread_id,
+                    "prev_message_id": prev_message_id,
+                    "trigger_summarization": False,
+                    "summary_batch_size": 1,
+                },
+            )
+            message_ids.append(prev_message_id)
+        return message_ids
+
+    a, b = asyncio.run(add_messages())
+
+    message_tree, _ = tree_cache.get(thread_id)
+    assert message_tree.index[a].child_ids == [b]
+    assert message_tree.index[b].parent_id == a
+
+
+class BlockingLLMOps(DummyLLMOps):
+    """
+    DummyLLMOps whose topic shift check waits on a barrier, when set, or a delay.
+    Records the peak count of concurrent checks.
+    """
+
+    def __init__(self, delay=0.0):
+        self.barrier = None
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def detect_topic_shift(self, prev, curr):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            if self.barrier is not None:
+                self.barrier.wait()  # Times out, unless both threads are checking at once
+            time.sleep(self.delay)
+        finally:
+            with self._lock:
+                self.active -= 1
+        return super().detect_topic_shift(prev, curr)
+
+
+def _add_message_payload(thread_id, content, prev_message_id):
+    return {
+        "content": content,
+        "thread_id": thread_id,
+        "prev_message_id": prev_message_id,
+        "trigger_summarization": True,
+        "summary_batch_size": 1,
+    }
+
+
+def test_dispatcher_adispatch_overlaps_threads(tmp_path):
+    """
+    Validates that updates of two chat threads are handled concurrently.
+    Each topic shift check waits for the other, which fails if they run in sequence.
+    """
+    db = DB(f"sqlite:///{tmp_path / 'chat.db'}")
+    llm_ops = BlockingLLMOps()
+    chat_dispatcher = ChatUpdateDispatcher(Handler(db, TreeCache(db, 2), llm_ops))
+    thread_ids = [db.insert_thread(), db.insert_thread()]
+    roots = [
+        chat_dispatcher.dispatch(
+            "add_message", _add_message_payload(thread_id, "Message A", None)
+        )
+        for thread_id in thread_ids
+    ]
+    llm_ops.barrier = threading.Barrier(2, timeout=5)
+
+    async def add_messages():
+        return await asyncio.gather(
+            *(
+                chat_dispatcher.adispatch(
+                    "add_message", _add_message_payload(thread_id, "Message B", root)
+                )
+                for thread_id, root in zip(thread_ids, roots)
+            )
+        )
+
+    asyncio.run(add_messages())
+    assert llm_ops.peak == 2
+
+
+def test_dispatcher_adispatch_serializes_thread(tmp_path):
+    """
+    Validates that concurrent updates of one chat thread run one at a time.
+    """
+    db = DB(f"sqlite:///{tmp_path / 'chat.db'}")
+    llm_ops = BlockingLLMOps(delay=0.05)
+    tree_cache = TreeCache(db, 2)
+    chat_dispatcher = ChatUpdateDispatcher(Handler(db, tree_cache, llm_ops))
+    thread_id = db.insert_thread()
+    root = chat_dispatcher.dispatch(
+        "add_message", _add_message_payload(thread_id, "Message A", None)
+    )
+
+    async def add_messages():
+        return await asyncio.gather(
+            *(
+                chat_dispatcher.adispatch(
+                    "add_message", _add_message_payload(thread_id, content, root)
+                )
+                for content in ["Message B", "Message C"]
+            )
+        )
+
+    b, c = asyncio.run(add_messages())
+    assert llm_ops.peak == 1
+    message_tree, _ = tree_cache.get(thread_id)
+    assert sorted(message_tree.index[root].child_ids) == sorted([b, c])
+
+
+def test_dispatcher_adispatch_rejects_thread_local_db(chat_dispatcher):
+    """
+    Validates that async dispatch refuses a plain in-memory database,
+    which its worker threads cannot see.
+    """
+    with pytest.raises(RuntimeError):
+        asyncio.run(chat_dispatcher.adispatch("add_message", {"thread_id": 1}))
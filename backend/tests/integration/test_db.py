@@ -0,0 +1,230 @@
+"""
+Integration tests for the DB service, against an in-memory SQLite database.
+
+Test Coverage:
+1. Link fetching is scoped to the requested thread
+2. Link deletion matches both ends of the link
+3. Batched message insertion
+    a. Message and link in one transaction
+    b. Bulk import of a linear chain
+4. Cached per-thread fetches
+    a. Invalidated by writes, of the written thread only
+    b. Results fetched during a write are not served
+    c. Expire after the TTL, bounding staleness from other writers
+5. Summary parents are resolved in the database
+6. File-backed SQLite runs in WAL mode
+7. No process-wide session is shared between calls
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import db.db as db_module
+from db.db import DB
+
+
+@pytest.fixture
+def db():
+    """
+    Returns a DB instance connected to an in-memory SQLite database.
+    Used for isolating tests without persistence.
+    """
+    return DB("sqlite:///:memory:")
+
+
+def test_fetch_links_scoped_to_thread(db):
+    """
+    Links of other threads must not leak into the result,
+    and no link may be repeated once per thread row.
+    """
+    thread_a = db.insert_thread()
+    thread_b = db.insert_thread()
+
+    a1 = db.insert_message(thread_a, "Message A1")
+    a2 = db.insert_message(thread_a, "Message A2")
+    b1 = db.insert_message(thread_b, "Message B1")
+    b2 = db.insert_message(thread_b, "Message B2")
+    link_a = db.insert_link(thread_a, a1, a2)
+    db.insert_link(thread_b, b1, b2)
+
+    links = db.fetch_links(thread_a)
+
+    assert [link["id"] for link in links] == [link_a]
+    assert links[0]["previous_message_id"] == a1
+    assert links[0]["next_message_id"] == a2
+
+
+def test_delete_link_matches_both_ends(db):
+    """
+    Only the link between the given messages is deleted,
+    even when other links share the same next message id.
+
+    Structure:
+        A → B,  C → B (in another thread)
+    """
+    thread_a = db.insert_thread()
+    thread_b = db.insert_thread()
+
+    a = db.insert_message(thread_a, "Message A")
+    b = db.insert_message(thread_a, "Message B")
+    c = db.insert_message(thread_b, "Message C")
+    db.insert_link(thread_b, c, b)
+    db.insert_link(thread_a, a, b)
+
+    db.delete_link(a, b)
+
+    assert db.fetch_links(thread_a) == []
+    assert [link["previous_message_id"] for link in db.fetch_links(thread_b)] == [c]
+
+
+def test_insert_message_with_link(db):
+    """
+    A root message gets no link; later messages are linked to their parent.
+    """
+    thread_id = db.insert_thread()
+
+    root_id, root_link_id = db.insert_message_with_link(thread_id, "Message A", None)
+    child_id, child_link_id = db.insert_message_with_link(
+        thread_id, "Message B", root_id
+    )
+
+    assert root_link_id is None
+    links = db.fetch_links(thread_id)
+    assert [link["id"] for link in links] == [child_link_id]
+    assert links[0]["previous_message_id"] == root_id
+    assert links[0]["next_message_id"] == child_id
+
+
+def test_bulk_insert_messages(db):
+    """
+    Bulk imported messages form a chain below the given message.
+
+    Structure:
+        A → B → C → D
+    """
+    thread_id = db.insert_thread()
+    a = db.insert_message(thread_id, "Message A")
+
+    b, c, d = db.bulk_insert_messages(
+        thread_id, ["Message B", "Message C", "Message D"], prev_message_id=a
+    )
+
+    contents = {m["id"]: m["content"] for m in db.fetch_messages(thread_id)}
+    assert contents == {a: "Message A", b: "Message B", c: "Message C", d: "Message D"}
+    links = {
+        (link["previous_message_id"], link["next_message_id"])
+        for link in db.fetch_links(thread_id)
+    }
+    assert links == {(a, b), (b, c), (c, d)}
+
+
+def test_fetch_cache_invalidated_by_writes(db):
+    """
+    Repeated fetches are served from cache, until the thread is written to.
+    """
+    thread_id = db.insert_thread()
+    a = db.insert_message(thread_id, "Message A")
+
+    bundle = db.fetch_thread_bundle(thread_id)
+    assert db.fetch_thread_bundle(thread_id) is bundle
+
+    b, _ = db.insert_message_with_link(thread_id, "Message B", a)
+    bundle = db.fetch_thread_bundle(thread_id)
+    assert [m["id"] for m in bundle["messages"]] == [a, b]
+
+    other_thread_id = db.insert_thread()
+    other_bundle = db.fetch_thread_bundle(other_thread_id)
+    db.insert_summary("Summary AB", a, b, None, thread_id=thread_id)
+    assert [s["id"] for s in db.fetch_thread_bundle(thread_id)["summaries"]] == [1]
+    assert db.fetch_thread_bundle(other_thread_id) is other_bundle
+
+
+def test_fetch_cache_skips_results_outdated_mid_fetch(db):
+    """
+    A result whose fetch overlapped a write is stored under an outdated key,
+    so the next fetch goes to the database.
+    """
+    thread_id = db.insert_thread()
+    fetches = []
+
+    def fetch_during_write():
+        fetches.append(1)
+        db._invalidate()  # A summary write, without a thread_id, lands mid-fetch
+        return {"stale": True}
+
+    db._cached("bundle", thread_id, fetch_during_write)
+    db._cached("bundle", thread_id, lambda: fetches.append(1) or {"stale": False})
+    assert len(fetches) == 2
+
+
+def test_fetch_cache_expires(monkeypatch):
+    """
+    Writes made by other processes are picked up, once the cached result expires.
+    """
+    clock = [0.0]
+    monkeypatch.setattr(db_module, "time", SimpleNamespace(monotonic=lambda: clock[0]))
+    db = DB("sqlite:///:memory:", result_cache_ttl=2.0)
+    thread_id = db.insert_thread()
+    db.insert_message(thread_id, "Message A")
+    assert len(db.fetch_messages(thread_id)) == 1
+
+    # Written behind the instance's back, as another process would
+    with db.db_engine.begin() as connection:
+        connection.execute(
+            text("INSERT INTO messages (thread_id, content) VALUES (:t, 'B')"),
+            {"t": thread_id},
+        )
+    assert len(db.fetch_messages(thread_id)) == 1
+
+    clock[0] = 2.5
+    assert len(db.fetch_messages(thread_id)) == 2
+
+
+def test_fetch_summary_graph(db):
+    """
+    A summary's parent is the summary ending right before its start message.
+
+    Structure:
+        [A → B] → [C → D]
+               ↘ [E]
+    """
+    thread_id = db.insert_thread()
+    a, b, c, d = db.bulk_insert_messages(
+        thread_id, ["Message A", "Message B", "Message C", "Message D"]
+    )
+    (e,) = db.bulk_insert_messages(thread_id, ["Message E"], prev_message_id=b)
+    ab = db.insert_summary("Summary AB", a, b, None)
+    cd = db.insert_summary("Summary CD", c, d, None)
+    e_ = db.insert_summary("Summary E", e, e, None)
+
+    graph = {
+        row["summary_id"]: row["parent_summary_id"]
+        for row in db.fetch_summary_graph(thread_id)
+    }
+    assert graph == {ab: None, cd: ab, e_: ab}
+    bundled = {
+        s["id"]: s["parent_summary_id"]
+        for s in db.fetch_thread_bundle(thread_id)["summaries"]
+    }
+    assert bundled == graph
+
+
+def test_file_sqlite_uses_wal(tmp_path):
+    """
+    File-backed SQLite databases are switched to write-ahead logging.
+    """
+    db = DB(f"sqlite:///{tmp_path / 'chat.db'}")
+    with db.db_engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+def test_no_shared_session(db):
+    """
+    Every DB call must check out its own session. A module or instance level
+    session would pin one connection and serialize all database access.
+    """
+    assert not any(isinstance(v, Session) for v in vars(db_module).values())
+    assert not any(isinstance(v, Session) for v in vars(db).values())
@@ -9,49 +9,94 @@ These tests verify that:
 
 NOTE: These tests use the actual OpenAI model via `langchain_openai.ChatOpenAI`.
 Ensure API keys and models are correctly configured via .env.
+The calls are issued concurrently once per module; each test asserts on its result.
 """
 
+import asyncio
+
 import pytest
 import os
 from dotenv import load_dotenv
 from services.llm_ops import LLMOps
 from db.models import Message
-from langchain_openai import ChatOpenAI
 
 # Load environment variables from .env
 load_dotenv()
 
-# Initialize the model (model name must be set in OPENAI_MODEL env var)
-llm = ChatOpenAI(model=os.getenv("OPENAI_MODEL"))
+pytestmark = pytest.mark.skipif(
+    not os.getenv("OPENAI_API_KEY"), reason="requires OpenAI credentials"
+)
+
+# (previous message, current message, expected topic shift)
+TOPIC_SHIFT_CASES = [
+    ("We should refactor the database.", "Let's switch to real-time analytics.", True),
+    (
+        "We should refactor the database.",
+        "Agreed, the database needs refactoring.",
+        False,
+    ),
+    (None, "Let's switch to real-time analytics.", False),
+]
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def llm_ops():
     """Provides an LLMOps instance configured with the OpenAI model."""
-    return LLMOps(llm)
+    from langchain_openai import ChatOpenAI
 
+    # Model name must be set in OPENAI_MODEL env var
+    return LLMOps(ChatOpenAI(model=os.getenv("OPENAI_MODEL")))
 
-@pytest.fixture
+
+@pytest.fixture(scope="module")
 def messages():
     """
     Provides a set of sample Message objects for testing LLM operations.
     Represents a small conversation thread about UI design.
     """
-    return [
+    return (
         Message(id=1, content="Let's design a new UI system."),
         Message(id=2, content="How about semantic zooming?"),
         Message(id=3, content="Could also use TUI as a fallback."),
-    ]
+    )
 
 
-def test_grouping(llm_ops, messages):
+@pytest.fixture(scope="module")
+def llm_results(llm_ops, messages):
+    """
+    Runs grouping, summarization and topic shift detection concurrently.
+    Returns the results keyed by operation.
+    """
+
+    async def run():
+        return await asyncio.gather(
+            asyncio.to_thread(llm_ops.group, messages),
+            asyncio.to_thread(llm_ops.generate_summary, messages),
+            asyncio.to_thread(
+                llm_ops.detect_topic_shifts,
+                [(prev, curr) for prev, curr, _ in TOPIC_SHIFT_CASES],
+            ),
+        )
+
+    groups, summary, shifts = asyncio.run(run())
+    return {
+        "group": groups,
+        "summary": summary,
+        "topic_shift": {
+            (prev, curr): shift
+            for (prev, curr, _), shift in zip(TOPIC_SHIFT_CASES, shifts)
+        },
+    }
+
+
+def test_grouping(llm_results):
     """
     Tests that the group function correctly clusters messages.
     Ensures:
     - Return type is a list of message groups (each group is a list)
     - All returned objects are instances of Message
     """
-    result = llm_ops.group(messages)
+    result = llm_results["group"]
 
     assert isinstance(result, list), "Expected list of groups"
     assert all(isinstance(g, list) for g in result), "Each group must be a list"
@@ -60,28 +105,28 @@ def test_grouping(llm_ops, messages):
     ), "Each item must be a Message instance"
 
 
-def test_summary_generation(llm_ops, messages):
+def test_summary_generation(llm_results):
     """
     Tests that a summary is generated from a list of messages.
     Ensures:
     - Return type is a non-empty string
     """
-    summary = llm_ops.generate_summary(messages)
+    summary = llm_results["summary"]
 
     assert isinstance(summary, str), "Summary must be a string"
     assert len(summary.strip()) > 0, "Summary must not be empty"
 
 
-def test_topic_shift_detection(llm_ops):
+@pytest.mark.parametrize("prev, curr, expected", TOPIC_SHIFT_CASES)
+def test_topic_shift_detection(llm_results, prev, curr, expected):
     """
     Tests that the topic shift detection logic correctly identifies change in topic.
     Ensures:
     - Return type is a boolean
     - Logical shift between database discussion and analytics triggers detection
+    - Restating the same point, and first messages, do not
     """
-    result = llm_ops.detect_topic_shift(
-        "We should refactor the database.", "Let's switch to real-time analytics."
-    )
+    result = llm_results["topic_shift"][(prev, curr)]
 
     assert isinstance(result, bool), "Return value must be boolean"
-    assert result is True, "Expected topic shift to be detected"
+    assert result is expected, f"Expected topic shift: {expected}"
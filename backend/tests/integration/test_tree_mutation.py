@@ -12,8 +12,12 @@ Test coverage:
 2. Summary insertion into summary_tree
 3. Counting unsummarized messages
 4. Splitting an existing summary
+5. Summary membership of messages
+6. LRU eviction of cached trees
 """
 
+import re
+
 import pytest
 
 from db.db import DB
@@ -32,11 +36,20 @@ def db():
 class DummyLLMOps:
     """Dummy class for mocking LLM operations."""
 
+    _TRIGGER = re.compile("new", re.IGNORECASE)
+
     def generate_summary(self, contents):
         return f"Summary({len(contents)} messages)"
 
     def detect_topic_shift(self, prev, curr):
-        return "new" in curr.lower()
+        return self._TRIGGER.search(curr) is not None
+
+
+def tree_structure(index: dict) -> dict[int, tuple]:
+    """Snapshots a node index as node_id --> (parent_id, child_ids)"""
+    return {
+        node_id: (node.parent_id, node.child_ids) for node_id, node in index.items()
+    }
 
 
 def test_tree_add_message(db):
@@ -54,14 +67,12 @@ def test_tree_add_message(db):
     message_tree.add_message(2, "Message C", 1)
     message_tree.add_message(3, "Message D", 0)  # Sibling branch
 
-    index = message_tree.index
-    assert index[0]["child_ids"] == [1, 3]
-    assert index[1]["parent_id"] == 0
-    assert index[1]["child_ids"] == [2]
-    assert index[2]["parent_id"] == 1
-    assert index[2]["child_ids"] == []
-    assert index[3]["parent_id"] == 0
-    assert index[3]["child_ids"] == []
+    assert tree_structure(message_tree.index) == {
+        0: (None, [1, 3]),
+        1: (0, [2]),
+        2: (1, []),
+        3: (0, []),
+    }
 
 
 def test_tree_add_summary(db):
@@ -99,12 +110,7 @@ def test_tree_add_summary(db):
     assert eml[5] == 2
 
     # Check summary tree structure
-    assert sil[0]["parent_id"] is None
-    assert sil[0]["child_ids"] == [1, 2]
-    assert sil[1]["parent_id"] == 0
-    assert sil[1]["child_ids"] == []
-    assert sil[2]["parent_id"] == 0
-    assert sil[2]["child_ids"] == []
+    assert tree_structure(sil) == {0: (None, [1, 2]), 1: (0, []), 2: (0, [])}
 
 
 def test_tree_count_unsummarized_messages(db):
@@ -136,6 +142,28 @@ def test_tree_count_unsummarized_messages(db):
 
     # Now the new branch should have 4 unsummarized messages
     assert summary_tree.count_unsummarized_messages(7) == 4
+    assert summary_tree.count_unsummarized_messages(1) == 0
+
+
+def test_tree_count_unsummarized_messages_on_load(db):
+    """
+    Test that unsummarized message counts are rebuilt when trees are loaded from the database.
+
+    Messages: A → B → C → D, with Summary AB
+    """
+    tree_cache = TreeCache(db, 2)
+    thread_id = db.insert_thread()
+    m1 = db.insert_message(thread_id, "Message A")
+    m2, m3, m4 = db.bulk_insert_messages(
+        thread_id, ["Message B", "Message C", "Message D"], prev_message_id=m1
+    )
+    db.insert_summary("Summary AB", m1, m2, None)
+
+    _, summary_tree = tree_cache.get(thread_id)
+
+    assert summary_tree.count_unsummarized_messages(m2) == 0
+    assert summary_tree.count_unsummarized_messages(m3) == 1
+    assert summary_tree.count_unsummarized_messages(m4) == 2
 
 
 def test_tree_split_summary(db):
@@ -166,12 +194,83 @@ def test_tree_split_summary(db):
     assert 0 not in sil
 
     # New structure
-    assert sil[1]["parent_id"] is None
-    assert sil[1]["child_ids"] == [2]
-    assert sil[2]["parent_id"] == 1
-    assert sil[2]["child_ids"] == []
+    assert tree_structure(sil) == {1: (None, [2]), 2: (1, [])}
 
     assert sml[0] == 1
     assert eml[0] == 1
     assert sml[1] == 2
     assert eml[1] == 2
+
+
+def test_tree_split_summary_relinks_neighbours(db):
+    """
+    Test that splitting a middle summary relinks its parent and children
+    to the new pre- and post-split summaries.
+    """
+    tree_cache = TreeCache(db, 2)
+    thread_id = db.insert_thread()
+    message_tree, summary_tree = tree_cache.get(thread_id)
+
+    # Chain 1 → 2 → ... → 5, summarized as [1-2], [3-4], [5]
+    message_tree.add_message(1, "Message A", None)
+    for message_id in range(2, 6):
+        message_tree.add_message(message_id, f"Message {message_id}", message_id - 1)
+    summary_tree.add_summary(1, "Summary A", 1, 2)
+    summary_tree.add_summary(2, "Summary B", 3, 4)
+    summary_tree.add_summary(3, "Summary C", 5, 5)
+
+    summary_tree.split_summary(2, 4, "Summary B-pre", 3, 5, "Summary B-post")
+
+    sil = summary_tree.index.summary_id_lookup
+    assert tree_structure(sil) == {
+        1: (None, [4]),
+        4: (1, [5]),
+        5: (4, [3]),
+        3: (5, []),
+    }
+
+
+def test_tree_is_summarized(db):
+    """
+    Test that every message within a summary span is reported as summarized,
+    and stays so after the summary is split.
+    """
+    tree_cache = TreeCache(db, 2)
+    thread_id = db.insert_thread()
+    message_tree, summary_tree = tree_cache.get(thread_id)
+
+    message_tree.add_message(0, "Message A", None)
+    message_tree.add_message(1, "Message B", 0)
+    message_tree.add_message(2, "Message C", 1)
+    message_tree.add_message(3, "Message D", 2)
+    summary_tree.add_summary(0, "Summary A", 0, 2)
+
+    assert all(summary_tree.is_summarized(i) for i in (0, 1, 2))
+    assert not summary_tree.is_summarized(3)
+
+    summary_tree.split_summary(0, 1, "Summary A-pre", 0, 2, "Summary A-post")
+
+    assert all(summary_tree.is_summarized(i) for i in (0, 1, 2))
+
+
+def test_tree_cache_lru_eviction(db):
+    """
+    Test that TreeCache evicts the least recently used thread,
+    and that a cache hit refreshes the recency of a thread.
+    """
+    tree_cache = TreeCache(db, 2)
+    thread_a = db.insert_thread()
+    thread_b = db.insert_thread()
+    thread_c = db.insert_thread()
+
+    trees_a = tree_cache.get(thread_a)
+    tree_cache.get(thread_b)
+    assert tree_cache.get(thread_a) is trees_a  # Hit; B is now least recent
+
+    tree_cache.get(thread_c)  # Evicts B
+
+    assert list(tree_cache.cache) == [thread_a, thread_c]
+    assert tree_cache.get(thread_a) is trees_a
+
+    del tree_cache[thread_a]
+    assert list(tree_cache.cache) == [thread_c]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from services.agent import Agent
+
+
+def test_stream_response_yields_tokens():
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="Hello there Reuben")]))
+    agent = Agent(llm)
+
+    tokens = list(agent.stream_response("Hello! My name is Reuben", "1"))
+
+    assert len(tokens) > 1
+    assert "".join(tokens) == "Hello there Reuben"
+
+
+def test_agenerate_response_returns_ai_message():
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="Hello Reuben")]))
+    agent = Agent(llm)
+
+    response = asyncio.run(agent.agenerate_response("Hello! My name is Reuben", "1"))
+
+    assert isinstance(response, AIMessage)
+    assert response.content == "Hello Reuben"
+
+
+def test_history_window_bounds_thread_state():
+    llm = GenericFakeChatModel(
+        messages=iter([AIMessage(content=f"Reply {i}") for i in range(3)])
+    )
+    agent = Agent(llm, history_window=3)
+    config = {"configurable": {"thread_id": "1"}}
+
+    for i in range(3):
+        agent.generate_response(f"Message {i}", "1")
+
+    messages = agent.graph.get_state(config).values["messages"]
+    assert [m.content for m in messages] == ["Reply 1", "Message 2", "Reply 2"]
+
+
+@pytest.mark.parametrize("history_window", [0, 1])
+def test_history_window_rejects_too_small(history_window):
+    llm = GenericFakeChatModel(messages=iter([]))
+    with pytest.raises(ValueError):
+        Agent(llm, history_window=history_window)
+
+
+def test_smallest_history_window_keeps_latest_message():
+    llm = GenericFakeChatModel(
+        messages=iter([AIMessage(content=f"Reply {i}") for i in range(2)])
+    )
+    agent = Agent(llm, history_window=2)
+    config = {"configurable": {"thread_id": "1"}}
+
+    for i in range(2):
+        agent.generate_response(f"Message {i}", "1")
+
+    messages = agent.graph.get_state(config).values["messages"]
+    assert [m.content for m in messages] == ["Message 1", "Reply 1"]
@@ -1,7 +1,16 @@
+import asyncio
+from types import SimpleNamespace
+
 import pytest
 from services.llm_ops import LLMOps
 from db.models import Message
 
+# Canned responses, built once and shared across calls
+GROUP_RESPONSE = SimpleNamespace(content="[[0, 1], [2]]")
+SUMMARY_RESPONSE = SimpleNamespace(content="This is a summary.")
+YES_RESPONSE = SimpleNamespace(content="Yes")
+NO_RESPONSE = SimpleNamespace(content="No")
+
 
 # Replace this with an actual mocked ChatOpenAI or use langchain's FakeLLM
 class FakeLLM:
@@ -9,12 +18,18 @@ class FakeLLM:
         system = messages[0].content
         human = messages[1].content
         if "group" in system:
-            return type("MockMsg", (), {"content": "[[0, 1], [2]]"})()
+            return GROUP_RESPONSE
         if "summarize" in system:
-            return type("MockMsg", (), {"content": "This is a summary."})()
+            return SUMMARY_RESPONSE
         if "Determine if" in system:
-            return type("MockMsg", (), {"content": "Yes"})()
-        return type("MockMsg", (), {"content": "No"})()
+            return YES_RESPONSE
+        return NO_RESPONSE
+
+    def batch(self, inputs, config=None):
+        return [self.invoke(messages) for messages in inputs]
+
+    async def ainvoke(self, messages):
+        return self.invoke(messages)
 
 
 @pytest.fixture
@@ -22,13 +37,14 @@ def llm_ops():
     return LLMOps(llm=FakeLLM())
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def sample_messages():
-    return [
+    # Read-only, so one tuple is shared by the module
+    return (
         Message(id=1, content="Let's brainstorm UI ideas."),
         Message(id=2, content="What if we try semantic zoom?"),
         Message(id=3, content="Maybe we simplify the layout."),
-    ]
+    )
 
 
 def test_group_returns_groups(llm_ops, sample_messages):
@@ -45,8 +61,73 @@ def test_generate_summary_returns_string(llm_ops, sample_messages):
     assert len(summary) > 0
 
 
+def test_generate_summaries_returns_strings(llm_ops):
+    summaries = llm_ops.generate_summaries([["Message A", "Message B"], ["Message C"]])
+    assert len(summaries) == 2
+    assert all(isinstance(summary, str) and summary for summary in summaries)
+
+
 def test_detect_topic_shift_returns_boolean(llm_ops):
     result = llm_ops.detect_topic_shift(
         "Let's talk about UI", "How about auth systems?"
     )
     assert isinstance(result, bool)
+
+
+def test_detect_topic_shifts_returns_booleans(llm_ops):
+    result = llm_ops.detect_topic_shifts(
+        [(None, "Let's talk about UI"), ("Let's talk about UI", "How about auth?")]
+    )
+    assert len(result) == 2
+    assert result[0] is False  # No previous message
+    assert isinstance(result[1], bool)
+
+
+def test_adetect_topic_shift_returns_boolean(llm_ops):
+    result = asyncio.run(
+        llm_ops.adetect_topic_shift("Let's talk about UI", "How about auth systems?")
+    )
+    assert isinstance(result, bool)
+    assert asyncio.run(llm_ops.adetect_topic_shift(None, "Hello")) is False
+
+
+def test_repeated_calls_served_from_cache(llm_ops, monkeypatch):
+    calls = []
+    invoke = FakeLLM.invoke
+    monkeypatch.setattr(
+        FakeLLM,
+        "invoke",
+        lambda self, messages: calls.append(1) or invoke(self, messages),
+    )
+
+    for _ in range(2):
+        llm_ops.detect_topic_shift("Let's talk about UI", "How about auth systems?")
+        llm_ops.generate_summary(["Let's brainstorm UI ideas.", "Maybe a sidebar?"])
+
+    assert len(calls) == 2
+
+
+def test_topic_shift_uses_dedicated_llm():
+    class YesLLM(FakeLLM):
+        def invoke(self, messages):
+            return YES_RESPONSE
+
+    llm_ops = LLMOps(llm=FakeLLM(), topic_shift_llm=YesLLM())
+    assert llm_ops.detect_topic_shift("Let's talk about UI", "How about auth?")
+    assert llm_ops.detect_topic_shifts([("Let's talk about UI", "Auth?")]) == [True]
+
+
+def test_batches_capped_by_llm_concurrency(monkeypatch):
+    configs = []
+
+    class RecordingLLM(FakeLLM):
+        def batch(self, inputs, config=None):
+            configs.append(config)
+            return super().batch(inputs, config)
+
+    monkeypatch.setenv("LLM_CONCURRENCY", "3")
+    llm_ops = LLMOps(llm=RecordingLLM())
+    llm_ops.generate_summaries([["Message A"], ["Message B"]])
+    llm_ops.detect_topic_shifts([("Let's talk about UI", "Auth?")])
+
+    assert configs == [{"max_concurrency": 3}] * 2